@@ -0,0 +1,485 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import types
+import numpy as np
+import pandas as pd
+import ParseKernels
+import SyntheticMorpheus
+from DataReader import DataReader
+from LoggerContext import LoggerContext
+from SimulationRunner import SimulationRunner
+from Metrics import metrics
+
+# grid_size, cell_nr and timesteps of the experiment configs
+scales = {"trial": (10, 51, 50), "production": (45, 1001, 50)}
+
+
+def synthetic_cell_states(grid_size, cell_nr, timesteps, seed=0):
+    """Cell id grids and cell states shaped like logger_4_cell.id.csv and logger_1.csv."""
+    rng = np.random.default_rng(seed)
+    ids = pd.DataFrame(
+        rng.integers(0, cell_nr, ((timesteps + 1) * grid_size, grid_size)),
+        columns=[str(x) for x in range(grid_size)],
+    )
+    cell_state = pd.DataFrame(
+        {
+            "time": np.repeat(range(timesteps + 1), cell_nr - 1),
+            "cell.id": np.tile(range(1, cell_nr), timesteps + 1),
+            "V": rng.integers(0, 2, (timesteps + 1) * (cell_nr - 1)),
+        }
+    )
+    return ids, cell_state
+
+
+def replace_cell_states_2d(ids, cell_state, grid_size):
+    """Former per-timestep DataFrame.replace implementation, kept as reference."""
+    id = ids.copy()
+    id["time"] = np.repeat(range(0, len(ids) // grid_size), grid_size)
+    cs = []
+    for t in id["time"].unique():
+        dict = (
+            cell_state[cell_state["time"] == t]
+            .drop(columns="time")
+            .set_index("cell.id")
+            .to_dict()["V"]
+        )
+        cs.append(id[id["time"] == t].drop(columns="time").replace(dict))
+    return pd.concat(cs).to_numpy().reshape(-1, grid_size, grid_size)
+
+
+def lookup_cell_states_2d(ids, cell_state, grid_size):
+    return ParseKernels.cell_states_2d(
+        ids.to_numpy().reshape(-1, grid_size, grid_size),
+        cell_state["time"].to_numpy(),
+        cell_state["cell.id"].to_numpy(),
+        cell_state["V"].to_numpy(),
+    )
+
+
+def best_of(func, repeats, *args):
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - start_time)
+    return min(timings), result
+
+
+def benchmark_cell_states(grid_size, cell_nr, timesteps, repeats=3):
+    ids, cell_state = synthetic_cell_states(grid_size, cell_nr, timesteps)
+    replace_time, expected = best_of(
+        replace_cell_states_2d, repeats, ids, cell_state, grid_size
+    )
+    lookup_time, result = best_of(
+        lookup_cell_states_2d, repeats, ids, cell_state, grid_size
+    )
+    if not np.array_equal(expected, result):
+        raise AssertionError("lookup table and replace results differ")
+    return {"replace": replace_time, "lookup": lookup_time}
+
+
+def pandas_V(context, config):
+    """Former groupby implementation of calculate_V on the parsed Ve frame, kept as
+    reference."""
+    df = context.ve_frame.copy()
+    df["time"] = np.repeat(range(0, config.timesteps + 1), config.grid_size)
+    df["sum_V"] = df.iloc[:, : config.grid_size].sum(axis=1)
+    df = df.drop(columns=[str(x) for x in range(0, config.grid_size)])
+    df = df.groupby(list(df.columns[:-1])).agg({"sum_V": "sum"}).reset_index()
+    return np.expand_dims(df["sum_V"], axis=1)[
+        config.cut_off_start + 1 : config.timesteps - config.cut_off_end
+    ]
+
+
+def pandas_volume(context, config):
+    """Former unique, merge and groupby implementation of calculate_volume on the
+    parsed cell ids and states, kept as reference."""
+    state = context.cell_states.rename(columns={"cell.id": "id"})
+    cell_id, counts = np.unique(
+        context.ids[config.cut_off_start + 1], return_counts=True
+    )
+    counts = np.append(
+        np.expand_dims(cell_id, axis=1), np.expand_dims(counts, axis=1), axis=1
+    )
+    if counts[0, 0] != 0:
+        counts = np.insert(counts, 0, [[0, 0]], axis=0)
+    counts = pd.DataFrame(counts, columns=["id", "count"])
+    df = pd.merge(left=state, right=counts, how="left", on=["id"])
+    df = df.groupby(["time", "V"]).agg({"count": "sum"}).reset_index()
+    return np.expand_dims(df.query("V == 1")["count"], axis=1)
+
+
+def kernel_V(context, config):
+    return np.expand_dims(ParseKernels.sum_V(context.ve), axis=1)[
+        config.cut_off_start + 1 : config.timesteps - config.cut_off_end
+    ]
+
+
+def kernel_volume(context, config):
+    state = context.cell_states
+    return np.expand_dims(
+        ParseKernels.infected_volume(
+            context.ids[config.cut_off_start + 1],
+            state["time"].to_numpy(),
+            state["cell.id"].to_numpy(),
+            state["V"].to_numpy(),
+        ),
+        axis=1,
+    )
+
+
+def benchmark_kernels(grid_size, cell_nr, timesteps, repeats=3):
+    """Time of the NumPy kernels of calculate_V and calculate_volume and of the former
+    pandas computations on the same parsed loggers of one synthetic simulation,
+    parsing excluded (see benchmark_reader for the end to end latency)."""
+    config = reader_config(grid_size, cell_nr, timesteps)
+    with tempfile.TemporaryDirectory() as folder:
+        SyntheticMorpheus.write_simulation(folder, grid_size, cell_nr, timesteps, 0)
+        context = LoggerContext(folder, config)
+        # parse every logger once, the timings below only cover the computation
+        context.ve, context.ve_frame, context.ids, context.cell_states
+
+    timings = {}
+    for name, reference, kernel in [
+        ("calculate_V", pandas_V, kernel_V),
+        ("calculate_volume", pandas_volume, kernel_volume),
+    ]:
+        pandas_time, expected = best_of(reference, repeats, context, config)
+        kernel_time, result = best_of(kernel, repeats, context, config)
+        if not np.array_equal(expected, result):
+            raise AssertionError("{} kernel and pandas results differ".format(name))
+        timings[name] = {"pandas": pandas_time, "kernel": kernel_time}
+    return timings
+
+
+def synthetic_batch(
+    grid_size, cell_nr, batch_size, nr_timesteps=30, seed=0, viral_load_dtype="float32"
+):
+    """Batch of spatial records and parameters like the samplers hand to the trainer."""
+    rng = np.random.default_rng(seed)
+    sim_data = np.empty(
+        (batch_size, grid_size, grid_size, nr_timesteps),
+        dtype=DataReader.record_dtype(viral_load_dtype),
+    )
+    sim_data["v"] = rng.lognormal(0, 2, sim_data.shape)
+    sim_data["id"] = rng.integers(0, cell_nr, sim_data.shape)
+    sim_data["I"] = rng.integers(0, 2, sim_data.shape)
+    return {"prior_draws": rng.random((batch_size, 2)), "sim_data": sim_data}
+
+
+def benchmark_configurator(
+    grid_size, cell_nr, batch_size=32, repeats=3, viral_load_dtype="float32"
+):
+    """Per-batch time of the NumPy prepare_input and of the float32 TensorFlow
+    GraphConfigurator, None if TensorFlow is not installed."""
+    forward_dict = synthetic_batch(
+        grid_size, cell_nr, batch_size, viral_load_dtype=viral_load_dtype
+    )
+    prior_means, prior_stds = np.full(2, 0.5), np.full(2, 0.29)
+    dataReader = DataReader(None, prior_means, prior_stds)
+    numpy_time, expected = best_of(dataReader.prepare_input, repeats, forward_dict)
+    try:
+        from GraphConfigurator import GraphConfigurator
+    except ImportError:
+        return {"numpy": numpy_time, "graph": None}
+
+    configurator = GraphConfigurator(prior_means, prior_stds)
+    # the first call traces the graph
+    configurator(forward_dict)
+    graph_time, result = best_of(configurator, repeats, forward_dict)
+    for key in expected:
+        np.testing.assert_allclose(
+            result[key].numpy(), expected[key], rtol=1e-6, atol=1e-6
+        )
+    return {"numpy": numpy_time, "graph": graph_time}
+
+
+def reader_config(grid_size, cell_nr, timesteps, **fields):
+    """Config of the fields the DataReader uses, with the cut-offs of the experiments."""
+    config = types.SimpleNamespace(
+        grid_size=grid_size,
+        cell_nr=cell_nr,
+        timesteps=timesteps,
+        cut_off_start=9,
+        cut_off_end=10,
+        prior_names=["DV", "bcf"],
+        param_nr=2,
+        spatial=True,
+    )
+    config.__dict__.update(fields)
+    return config
+
+
+def peak_memory(func, *args):
+    """Peak of the memory traced by tracemalloc (numpy included) during func."""
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_reader(grid_size, cell_nr, timesteps, nr_of_simulations=16, repeats=3):
+    """Per-simulation latency, throughput and peak memory of the DataReader on
+    synthetic simulations written by SyntheticMorpheus."""
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        output = os.path.join(folder, "output")
+        paths = SyntheticMorpheus.write_folder(
+            output, nr_of_simulations, grid_size, cell_nr, timesteps, ["DV", "bcf"]
+        )
+        dataReader = DataReader(reader_config(grid_size, cell_nr, timesteps), 0, 1)
+        per_simulation = {
+            "calculate_V": lambda: [
+                dataReader.calculate_V(os.path.join(x, "logger_6_Ve.csv"))
+                for x in paths
+            ],
+            "calculate_volume": lambda: [dataReader.calculate_volume(x) for x in paths],
+            "get_cell_states_2d": lambda: [
+                dataReader.get_cell_states_2d(x) for x in paths
+            ],
+            "read_offline_data": lambda: dataReader.read_offline_data(
+                os.path.join(output, "*"), folder, workers=1
+            ),
+            "read_offline_data_2d": lambda: dataReader.read_offline_data_2d(
+                os.path.join(output, "*"), folder, workers=1
+            ),
+        }
+        for name, func in per_simulation.items():
+            elapsed_time = best_of(func, repeats)[0]
+            results[name] = {
+                "latency_ms": elapsed_time * 1_000 / nr_of_simulations,
+                "throughput": nr_of_simulations / elapsed_time,
+                "peak_mb": peak_memory(func) / 2**20,
+            }
+    return results
+
+
+def regressions(results, baseline, tolerance=0.25):
+    """Latencies and peak memories which grew by more than tolerance compared to
+    the baseline results."""
+    found = []
+    for scale, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            reference = baseline.get(scale, {}).get(name)
+            if reference is None:
+                continue
+            for metric in ["latency_ms", "peak_mb"]:
+                if result[metric] > reference[metric] * (1 + tolerance):
+                    found.append(
+                        "{} {} {}: {:.2f} (baseline {:.2f})".format(
+                            scale, name, metric, result[metric], reference[metric]
+                        )
+                    )
+    return found
+
+
+def write_model(path, grid_size, timesteps):
+    """Minimal Morpheus model with the lattice size and stop time FakeMorpheus reads."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n<MorpheusModel version="4">\n'
+            '    <Time><StartTime value="0"/><StopTime value="{}"/></Time>\n'
+            '    <Space><Lattice class="square"><Size value="{}, {}, 0"/></Lattice>'
+            "</Space>\n</MorpheusModel>\n".format(timesteps, grid_size, grid_size)
+        )
+
+
+def benchmark_simulation(
+    grid_size, cell_nr, timesteps, nr_of_simulations=8, sleep="0.2", workers=(1, 2, 4)
+):
+    """Simulations per second of run, run_2d and the batched runs for every number of
+    workers through FakeMorpheus, which sleeps for sleep seconds per simulation,
+    and the mean milliseconds per simulation of the launch, morpheus, completion and
+    parse stages the SimulationRunner records in the metrics registry."""
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        config = reader_config(
+            grid_size,
+            cell_nr,
+            timesteps,
+            data_path=folder,
+            folder="output",
+            model_pattern="model.xml",
+            fixed_params={},
+            morpheus_executable=os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), "FakeMorpheus.py"
+            ),
+        )
+        write_model(os.path.join(folder, "model", "model.xml"), grid_size, timesteps)
+        os.environ["FAKE_MORPHEUS_SLEEP"] = sleep
+        os.environ["FAKE_MORPHEUS_CELL_NR"] = str(cell_nr)
+        simulationRunner = SimulationRunner(config, folder, DataReader(config, 0, 1))
+        params_batch = np.random.default_rng(0).random((nr_of_simulations, 2))
+
+        paths = {
+            "run": lambda: [simulationRunner.run(x) for x in params_batch],
+            "run_2d": lambda: [simulationRunner.run_2d(x) for x in params_batch],
+        }
+        for worker_nr in workers:
+            paths[
+                "run_batch/{}".format(worker_nr)
+            ] = lambda worker_nr=worker_nr: simulationRunner.run_batch(
+                params_batch, worker_nr
+            )
+            paths[
+                "run_2d_batch/{}".format(worker_nr)
+            ] = lambda worker_nr=worker_nr: simulationRunner.run_2d_batch(
+                params_batch, worker_nr
+            )
+        enabled, metrics.enabled = metrics.enabled, True
+        try:
+            for name, func in paths.items():
+                metrics.reset()
+                elapsed_time = best_of(func, 1)[0]
+                timers = metrics.summary()["timers"]
+                results[name] = {
+                    "throughput": nr_of_simulations / elapsed_time,
+                    "stages_ms": {
+                        stage: timers["simulation." + stage]["mean"] * 1_000
+                        for stage in ["launch", "morpheus", "completion", "parse"]
+                    },
+                }
+        finally:
+            metrics.enabled = enabled
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Benchmark",
+        description="Times the parsing kernels of the DataReader",
+    )
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    parser.add_argument(
+        "-n", "--simulations", type=int, default=16, help="synthetic simulations"
+    )
+    parser.add_argument(
+        "-b", "--baseline", type=str, help="json file of the reader baseline"
+    )
+    parser.add_argument(
+        "-u",
+        "--update_baseline",
+        action="store_true",
+        help="write the reader results as new baseline",
+    )
+    parser.add_argument("-t", "--tolerance", type=float, default=0.25)
+    parser.add_argument(
+        "--simulation",
+        action="store_true",
+        help="also run simulations end to end through FakeMorpheus",
+    )
+    parser.add_argument(
+        "--sleep", type=str, default="0.2", help='seconds per simulation or "a:b"'
+    )
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument(
+        "--viral_load_dtype", type=str, default="float32", help="of spatial batches"
+    )
+    args = parser.parse_args()
+
+    for scale, (grid_size, cell_nr, timesteps) in scales.items():
+        timings = benchmark_cell_states(grid_size, cell_nr, timesteps, args.repeats)
+        print(
+            "get_cell_states_2d {} (grid {}): replace {:.1f} ms, lookup {:.2f} ms, "
+            "speedup {:.0f}x".format(
+                scale,
+                grid_size,
+                timings["replace"] * 1_000,
+                timings["lookup"] * 1_000,
+                timings["replace"] / timings["lookup"],
+            )
+        )
+
+    for scale, (grid_size, cell_nr, timesteps) in scales.items():
+        for name, timings in benchmark_kernels(
+            grid_size, cell_nr, timesteps, args.repeats
+        ).items():
+            print(
+                "{} {} (grid {}, parsed loggers): pandas {:.2f} ms, kernel {:.2f} ms, "
+                "speedup {:.0f}x".format(
+                    name,
+                    scale,
+                    grid_size,
+                    timings["pandas"] * 1_000,
+                    timings["kernel"] * 1_000,
+                    timings["pandas"] / timings["kernel"],
+                )
+            )
+
+    for scale, (grid_size, cell_nr, timesteps) in scales.items():
+        timings = benchmark_configurator(
+            grid_size,
+            cell_nr,
+            repeats=args.repeats,
+            viral_load_dtype=args.viral_load_dtype,
+        )
+        if timings["graph"] is None:
+            print(
+                "prepare_input {} (grid {}): numpy {:.1f} ms per batch, "
+                "TensorFlow not installed".format(
+                    scale, grid_size, timings["numpy"] * 1_000
+                )
+            )
+            continue
+        print(
+            "prepare_input {} (grid {}): numpy {:.1f} ms, graph {:.1f} ms per "
+            "batch".format(
+                scale, grid_size, timings["numpy"] * 1_000, timings["graph"] * 1_000
+            )
+        )
+
+    reader_results = {}
+    for scale, (grid_size, cell_nr, timesteps) in scales.items():
+        reader_results[scale] = benchmark_reader(
+            grid_size, cell_nr, timesteps, args.simulations, args.repeats
+        )
+        for name, result in reader_results[scale].items():
+            print(
+                "{} {} (grid {}): {:.2f} ms per simulation, {:.1f} simulations/s, "
+                "peak {:.1f} MB".format(
+                    name,
+                    scale,
+                    grid_size,
+                    result["latency_ms"],
+                    result["throughput"],
+                    result["peak_mb"],
+                )
+            )
+
+    for scale, (grid_size, cell_nr, timesteps) in scales.items():
+        if not args.simulation:
+            break
+        results = benchmark_simulation(
+            grid_size, cell_nr, timesteps, args.simulations, args.sleep, args.workers
+        )
+        for name, result in results.items():
+            print(
+                "{} {} (grid {}): {:.2f} simulations/s, {}".format(
+                    name,
+                    scale,
+                    grid_size,
+                    result["throughput"],
+                    ", ".join(
+                        "{} {:.1f} ms".format(stage, value)
+                        for stage, value in result["stages_ms"].items()
+                    ),
+                )
+            )
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(reader_results, f, indent=2)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(reader_results, json.load(f), args.tolerance)
+        for regression in found:
+            print("REGRESSION " + regression)
+        if len(found) > 0:
+            raise SystemExit(1)
@@ -1,234 +1,660 @@
+import hashlib
 import os
+import shutil
 import pandas as pd
 import numpy as np
 import glob
-from Utility import timeit
+import multiprocessing as mp
+from Utility import timeit, shared_empty, logger_stat, available_memory
+from ParseCache import ParseCache, cached
+import ParseKernels
+from LoggerContext import LoggerContext
+from SimulationManifest import SimulationManifest
+from MemoryMonitor import MemoryMonitor
+from collections import Counter
 from tqdm import tqdm
 from contextlib import redirect_stdout, redirect_stderr
 
 
+_worker_state = {}
+
+
+def _init_read_worker(read_simulation, path_list, dfs):
+    _worker_state.update(read_simulation=read_simulation, path_list=path_list, dfs=dfs)
+
+
+def _read_into_slot(index):
+    try:
+        sim = _worker_state["read_simulation"](_worker_state["path_list"][index])
+    except Exception:
+        return index, False
+    _worker_state["dfs"][index] = sim
+    return index, True
+
+
 class DataReader:
+    @staticmethod
+    def record_dtype(viral_load_dtype="float32"):
+        """dtype of the spatial simulations, which keep every channel in its natural
+        dtype; the channels are converted to float in prepare_input one batch at a
+        time. The lossless layout needs 7 instead of 12 bytes per site of a float32
+        channel axis, only a float16 viral load gets below half with 5 bytes."""
+        return np.dtype([("v", viral_load_dtype), ("id", np.uint16), ("I", np.uint8)])
+
     def __init__(self, config, prior_means, prior_stds):
         self.config = config
         self.prior_means = prior_means
         self.prior_stds = prior_stds
+        self.spatial_dtype = self.record_dtype(
+            getattr(config, "viral_load_dtype", "float32")
+        )
+        # cut populations parsed by the first pass, used once by get_simulation
+        self.checked_populations = {}
+        self.parse_cache = (
+            ParseCache(config, getattr(config, "parse_cache_dir", None))
+            if getattr(config, "parse_cache", False)
+            else None
+        )
 
-    def calculate_V(self, path: str):
-        df = pd.read_csv(path, sep="\t")
-        df = df[df[str(self.config.grid_size)] != self.config.grid_size]
-        morpheus_ts = np.repeat(
-            range(0, self.config.timesteps + 1), self.config.grid_size
+    def context(self, path):
+        """Shared parse context of the simulation directory path (or of the directory
+        of a logger file), passed through if path already is one.
+        """
+        if isinstance(path, LoggerContext):
+            return path
+        if not os.path.isdir(path):
+            path = os.path.dirname(path)
+        return LoggerContext(path, self.config)
+
+    @cached("logger_2.csv")
+    def get_population(self, path):
+        return self.context(path).population
+
+    @cached("logger_6_Ve.csv")
+    def calculate_V(self, path):
+        return np.expand_dims(ParseKernels.sum_V(self.context(path).ve), axis=1)[
+            self.config.cut_off_start
+            + 1 : self.config.timesteps
+            - self.config.cut_off_end
+        ]
+
+    @cached("logger_1.csv", "logger_4_cell.id.csv")
+    def calculate_volume(self, path):
+        context = self.context(path)
+        state = context.cell_states
+        # cell volumes are frozen at the first timestep after the cut off
+        return np.expand_dims(
+            ParseKernels.infected_volume(
+                context.ids[self.config.cut_off_start + 1],
+                state["time"].to_numpy(),
+                state["cell.id"].to_numpy(),
+                state["V"].to_numpy(),
+            ),
+            axis=1,
         )
-        times = np.tile(morpheus_ts, int(len(df.index) / morpheus_ts.shape[0]))
-        if len(times) != len(df.index):
-            print(path)
-        df["time"] = np.tile(morpheus_ts, int(len(df.index) / morpheus_ts.shape[0]))
-        df["sum_V"] = df.iloc[:, 1 : self.config.grid_size + 1].sum(axis=1)
-        df = df.drop(columns=[str(x) for x in range(0, self.config.grid_size + 1)])
-        df = df.groupby(list(df.columns[:-1])).agg({"sum_V": "sum"}).reset_index()
-        return np.expand_dims(df["sum_V"], axis=1)[
+
+    def get_simulation(self, path):
+        """Observables (target cells, infected cells, viral load, infected volume) of
+        one simulation after cutting off the start and end.
+        """
+        context = self.context(path)
+        population = self.checked_populations.pop(context.path, None)
+        if population is None:
+            population = self.get_population(context)[
+                self.config.cut_off_start
+                + 1 : self.config.timesteps
+                - self.config.cut_off_end
+            ]
+        V = self.calculate_V(context)
+        I_volume = self.calculate_volume(context)[
             self.config.cut_off_start
             + 1 : self.config.timesteps
             - self.config.cut_off_end
         ]
+        return np.append(np.append(population, V, axis=1), I_volume, axis=1)
 
-    def calculate_volume(self, path: str):
-        logger_state = "logger_1.csv"
-        logger_volume = "logger_4_cell.id.csv"
-        state = pd.read_csv(os.path.join(path, logger_state), sep="\t").rename(
-            columns={"cell.id": "id"}
+    def get_simulation_2d(self, path):
+        """(grid, grid, time) record array of one simulation with the channels viral
+        load, cell id and infection state (see spatial_dtype), after cutting off the
+        start and end.
+        """
+        context = self.context(path)
+        cut_off = slice(
+            self.config.cut_off_start + 1,
+            self.config.timesteps - self.config.cut_off_end,
         )
-        volume = np.genfromtxt(os.path.join(path, logger_volume), delimiter="\t")
-        lines_per_timepoint = (self.config.timesteps + 1) * (self.config.grid_size + 1)
-        volume = np.delete(
-            volume,
-            list(range(0, int(lines_per_timepoint), self.config.grid_size + 1)),
-            axis=0,
+        sim = np.empty(
+            (
+                self.config.grid_size,
+                self.config.grid_size,
+                cut_off.stop - cut_off.start,
+            ),
+            dtype=self.spatial_dtype,
         )
+        channels = {
+            "v": self.calculate_V_2d(context),
+            "id": self.get_ids_2d(context),
+            "I": self.get_cell_states_2d(context),
+        }
+        for name, channel in channels.items():
+            channel = channel.transpose((1, 2, 0))[:, :, cut_off]
+            dtype = sim.dtype[name]
+            info = np.iinfo(dtype) if dtype.kind == "u" else np.finfo(dtype)
+            if channel.min(initial=0) < info.min or channel.max(initial=0) > info.max:
+                raise ValueError(
+                    "channel {} does not fit into {}".format(name, dtype.name)
+                )
+            sim[name] = channel
+        return sim
 
-        first_ts_after_freeze = self.config.grid_size * (self.config.cut_off_start + 1)
-        cell_id, counts = np.array(
-            np.unique(
-                np.array(volume)[
-                    first_ts_after_freeze : first_ts_after_freeze
-                    + self.config.grid_size,
-                    1:,
-                ],
-                return_counts=True,
+    def __check_simulation__(self, pathname: str):
+        """Cheap validity check of one simulation directory from its name and its
+        population logger. Returns the parameters and None, or None and the reason
+        the simulation is dropped.
+        """
+        nr_of_params = self.config.param_nr
+        path_split = pathname.split("/")[len(pathname.split("/")) - 1]
+        if "e" in path_split:
+            return None, "parameter in exponent notation"
+        if path_split.startswith("sweep") or path_split.startswith("DV"):
+            start_nr = 1
+        else:
+            start_nr = 0
+        params_split = path_split.split("_")[start_nr : nr_of_params + 1]
+        param_file = list(map(lambda x: round(float(x.split("-")[1]), 3), params_split))
+        if np.any(np.asarray(param_file) > 1):
+            return None, "parameter out of range"
+        if not all(
+            os.path.exists(os.path.join(pathname, x)) for x in LoggerContext.loggers
+        ):
+            return None, "missing logger"
+
+        try:
+            population = self.get_population(pathname)
+        except Exception:
+            return None, "unreadable population logger"
+        df_inf = population[:, 1:2][
+            self.config.cut_off_start
+            + 1 : self.config.timesteps
+            - self.config.cut_off_end
+        ]
+        if len(df_inf) != (
+            self.config.timesteps
+            - 1
+            - self.config.cut_off_start
+            - self.config.cut_off_end
+        ):
+            return None, "incomplete population logger"
+        if np.any(df_inf < 1):
+            return None, "no infected cells"
+        self.checked_populations[pathname] = population[
+            self.config.cut_off_start
+            + 1 : self.config.timesteps
+            - self.config.cut_off_end
+        ].copy()
+        return param_file, None
+
+    def __check_simulation_2d__(self, pathname: str):
+        """Cheap validity check of one spatial simulation directory from its name.
+        Returns the parameters and None, or None and the reason it is dropped.
+        """
+        path_split = pathname.split("/")[len(pathname.split("/")) - 1]
+        if "e" in path_split:
+            return None, "parameter in exponent notation"
+        if not all(
+            os.path.exists(os.path.join(pathname, x)) for x in LoggerContext.loggers_2d
+        ):
+            return None, "missing logger"
+
+        params_dict = {
+            i.split("-")[0]: round(float(i.split("-")[1]), 3)
+            for i in path_split.split("_")
+            if i.split("-")[0] in self.config.prior_names
+        }
+        return list(params_dict.values()), None
+
+    def manifest(self, path_list, spatial: bool = False):
+        """First pass of the offline readers: checks every simulation without parsing
+        its spatial loggers. Returns the paths and the (n_valid, n_params) parameters
+        of the valid simulations and the number of dropped simulations per reason.
+        """
+        check = self.__check_simulation_2d__ if spatial else self.__check_simulation__
+        valid_paths, params, dropped = [], [], Counter()
+        for pathname in path_list:
+            param_file, reason = check(pathname)
+            if reason is not None:
+                dropped[reason] += 1
+                continue
+            valid_paths.append(pathname)
+            params.append(param_file)
+        params = np.asarray(params, dtype=np.float32).reshape(
+            len(valid_paths), self.config.param_nr
+        )
+        return valid_paths, params, dropped
+
+    def __select__(self, path: str, spatial: bool, path_list=None):
+        """Paths and parameters of the valid simulations matched by the glob path, the
+        dropped simulations per reason and the number of matched simulations. With
+        config.offline_manifest they are taken from the manifest of the folder,
+        optionally restricted to config.offline_param_ranges. path_list restricts
+        the selection to these paths.
+        """
+        folder, pattern = os.path.split(path)
+        if not getattr(self.config, "offline_manifest", False) or glob.has_magic(
+            folder
+        ):
+            all_paths = glob.glob(path) if path_list is None else path_list
+            return (*self.manifest(all_paths, spatial), len(all_paths))
+
+        manifest = SimulationManifest(
+            self.config,
+            folder,
+            spatial,
+            self.__check_simulation_2d__ if spatial else self.__check_simulation__,
+            LoggerContext.loggers_2d if spatial else LoggerContext.loggers,
+        )
+        # incremental refreshes ask for directories whose loggers changed
+        index = manifest.select(
+            manifest.current(
+                path_list is not None
+                or getattr(self.config, "offline_manifest_refresh", False)
+            ),
+            pattern,
+            getattr(self.config, "offline_param_ranges", None),
+        )
+        if path_list is not None:
+            names = {os.path.basename(x) for x in path_list}
+            index = index[index["name"].isin(names)]
+        dropped = Counter(index["reason"][~index["valid"]])
+        index = index[index["valid"]]
+        path_list = [os.path.join(folder, x) for x in index["name"]]
+        # checked directories outside the selection are not read
+        selected = set(path_list)
+        self.checked_populations = {
+            x: population
+            for x, population in self.checked_populations.items()
+            if x in selected
+        }
+        return (
+            path_list,
+            manifest.params(index),
+            dropped,
+            len(path_list) + sum(dropped.values()),
+        )
+
+    @staticmethod
+    def report(nr_of_paths, dropped):
+        print("Dropped {} of {} simulations".format(sum(dropped.values()), nr_of_paths))
+        for reason, count in dropped.most_common():
+            print("  {}: {}".format(reason, count))
+
+    def sim_shape(self, spatial: bool = False):
+        """Shape of one parsed simulation after cutting off the start and end."""
+        nr_timesteps = (
+            self.config.timesteps
+            - 1
+            - self.config.cut_off_start
+            - self.config.cut_off_end
+        )
+        if spatial:
+            return (self.config.grid_size, self.config.grid_size, nr_timesteps)
+        return (nr_timesteps, 4)
+
+    def sim_dtype(self, spatial: bool = False):
+        """dtype of the parsed simulations."""
+        return self.spatial_dtype if spatial else np.dtype(np.float32)
+
+    def footprint(self, nr_of_simulations: int, spatial: bool = False):
+        """Projected bytes of nr_of_simulations parsed simulations and their
+        parameters, every channel counted in the dtype it is stored in."""
+        sim_bytes = (
+            int(np.prod(self.sim_shape(spatial))) * self.sim_dtype(spatial).itemsize
+        )
+        param_bytes = self.config.param_nr * np.dtype(np.float32).itemsize
+        return nr_of_simulations * (sim_bytes + param_bytes)
+
+    def memory_budget(self):
+        """Bytes the offline data may take in RAM: config.memory_budget in GB, by
+        default the memory currently available. None if unknown."""
+        budget = getattr(self.config, "memory_budget", None)
+        if budget is None:
+            return available_memory()
+        return int(budget * 2**30)
+
+    def __allocate__(self, shape, spatial: bool, workdir):
+        """Array the second pass parses shape simulations into. None leaves it to
+        __read_all__, i.e. RAM. If the projected footprint exceeds the memory budget
+        the simulations are parsed into a memory map in config.memmap_dir (the workdir
+        by default). Raises a MemoryError before anything is parsed if the data fits
+        neither into the budget nor onto the disk.
+        """
+        footprint = self.footprint(shape[0], spatial)
+        budget = self.memory_budget()
+        print(
+            "Projected dataset size: {:.3f} GB, memory budget: {}".format(
+                footprint / 2**30,
+                "unknown" if budget is None else "{:.3f} GB".format(budget / 2**30),
             )
         )
-        counts = np.append(
-            np.expand_dims(cell_id, axis=1), np.expand_dims(counts, axis=1), axis=1
+        if budget is None or footprint <= budget:
+            return None
+
+        directory = getattr(self.config, "memmap_dir", None) or workdir
+        free = shutil.disk_usage(directory).free
+        if footprint > free:
+            raise MemoryError(
+                "{} simulations need {:.3f} GB, more than the memory budget of {:.3f} "
+                "GB and the {:.3f} GB free in {}".format(
+                    shape[0],
+                    footprint / 2**30,
+                    budget / 2**30,
+                    free / 2**30,
+                    directory,
+                )
+            )
+        file = os.path.join(
+            directory, "offline_data_2d.npy" if spatial else "offline_data.npy"
+        )
+        print("Exceeds the memory budget, reading into the memory map", file)
+        return np.lib.format.open_memmap(
+            file, mode="w+", dtype=self.sim_dtype(spatial), shape=shape
+        )
+
+    def __read_all__(
+        self, read_simulation, path_list, shape, dtype, workers=None, out=None
+    ):
+        """Second pass of the offline readers: parses every simulation of path_list
+        into an array of the given shape. With more than one worker the directories
+        are parsed by a process pool, each worker writing its simulation directly into
+        its slot of a shared array. out may be a preallocated array, e.g. a file
+        backed memory map. Returns the array and the sorted indices of the
+        simulations which could not be parsed.
+        """
+        if workers is None:
+            workers = getattr(self.config, "read_workers", 1)
+        if workers is None:
+            workers = os.cpu_count()
+        workers = min(workers, len(path_list))
+
+        n_sim = len(path_list)
+        invalidIndices = []
+
+        if workers <= 1 or "fork" not in mp.get_all_start_methods():
+            dfs = np.empty(shape, dtype=dtype) if out is None else out
+            for path in tqdm(range(n_sim)):
+                try:
+                    dfs[path] = read_simulation(path_list[path])
+                except Exception:
+                    invalidIndices.append(path)
+            return dfs, invalidIndices
+
+        # shared mappings are inherited by the forked workers, so only indices and
+        # validity flags travel through the pool
+        dfs = shared_empty(shape, dtype) if out is None else out
+        with mp.get_context("fork").Pool(
+            workers,
+            initializer=_init_read_worker,
+            initargs=(read_simulation, path_list, dfs),
+        ) as pool:
+            chunksize = max(1, min(64, n_sim // (workers * 8)))
+            for path, valid in tqdm(
+                pool.imap_unordered(_read_into_slot, range(n_sim), chunksize),
+                total=n_sim,
+            ):
+                if not valid:
+                    invalidIndices.append(path)
+        # the workers used their copies of the checked populations
+        for path in path_list:
+            self.checked_populations.pop(path, None)
+        invalidIndices.sort()
+        return dfs, invalidIndices
+
+    @staticmethod
+    def __compact__(dfs, params, invalidIndices):
+        """Drops the rows invalidIndices by moving the following rows up in place,
+        unlike np.delete no second copy of the dataset is made."""
+        if len(invalidIndices) == 0:
+            return dfs, params
+        valid = np.ones(len(dfs), dtype=bool)
+        valid[invalidIndices] = False
+        for target, source in enumerate(np.flatnonzero(valid)):
+            if target != source:
+                dfs[target] = dfs[source]
+                params[target] = params[source]
+        return dfs[: valid.sum()], params[: valid.sum()]
+
+    def holdout(self, params):
+        """Sorted positions of the rows of params held out of training as validation
+        set if config.validation_source is "offline": the
+        resimulation_param["simulations"] rows with the smallest hash of
+        config.validation_seed and their parameters. The choice does not depend on
+        the order of the simulations, and appended simulations never move a training
+        simulation into the validation set.
+        """
+        if getattr(self.config, "validation_source", "simulate") != "offline":
+            return np.empty(0, dtype=np.intp)
+        params = np.asarray(params, dtype=np.float32)
+        size = min(self.config.resimulation_param["simulations"], len(params))
+        seed = repr(getattr(self.config, "validation_seed", 0)).encode()
+        keys = np.array([hashlib.sha1(seed + x.tobytes()).digest() for x in params])
+        return np.sort(np.argsort(keys, kind="stable")[:size])
+
+    def __read_offline__(self, path: str, spatial: bool, workdir, workers: int = None):
+        """Reads the valid simulations matched by path into RAM, or into a memory map
+        if they exceed the memory budget. With config.memory_report the memory of
+        every phase is written to memory_read_offline.json in the workdir.
+        """
+        monitor = MemoryMonitor(getattr(self.config, "memory_report", False))
+        with monitor.phase("select"):
+            path_list, params, dropped, nr_of_paths = self.__select__(path, spatial)
+        shape = (len(path_list), *self.sim_shape(spatial))
+        out = self.__allocate__(shape, spatial, workdir)
+        with monitor.phase("read"):
+            dfs, invalidIndices = self.__read_all__(
+                self.get_simulation_2d if spatial else self.get_simulation,
+                path_list,
+                shape,
+                self.sim_dtype(spatial),
+                workers,
+                out=out,
+            )
+        dropped["parse error"] += len(invalidIndices)
+        self.report(nr_of_paths, +dropped)
+
+        with monitor.phase("compact"):
+            dfs, params = self.__compact__(dfs, params, invalidIndices)
+        print("Read data in the form of: ", dfs.shape)
+        monitor.write(
+            os.path.join(workdir, "memory_read_offline.json"),
+            footprint=self.footprint(len(path_list), spatial),
+            budget=self.memory_budget(),
+            memory_mapped=out is not None,
         )
-        if counts[0, 0] != 0:
-            counts = np.insert(counts, 0, [[0, 0]], axis=0)
-        counts = pd.DataFrame(counts, columns=["id", "count"])
-        df = pd.merge(left=state, right=counts, how="left", on=["id"])
-        df = df.groupby(["time", "V"]).agg({"count": "sum"}).reset_index()
-        return np.expand_dims(df.query("V == 1")["count"], axis=1)
+        return dfs, params
 
     @timeit
-    def read_offline_data(self, path: str, workdir):
+    def read_offline_data(self, path: str, workdir, workers: int = None):
         with open(os.path.join(workdir, "log_read_offline.txt"), "w") as logfile:
             with redirect_stdout(logfile), redirect_stderr(logfile):
-                path_list = glob.glob(path)
-                nr_of_params = self.config.param_nr
-
-                n_sim = len(path_list)
-                dfs = np.empty(
-                    (
-                        n_sim,
-                        (
-                            self.config.timesteps
-                            - 1
-                            - self.config.cut_off_start
-                            - self.config.cut_off_end
-                        ),
-                        4,
-                    ),
-                    dtype=np.float32,
-                )
-                params = np.empty((n_sim, nr_of_params), dtype=np.float32)
-                invalidIndices = []
+                return self.__read_offline__(path, False, workdir, workers)
+
+    @timeit
+    def read_offline_data_2d(self, path: str, workdir, workers: int = None):
+        with open(os.path.join(workdir, "log_read_offline.txt"), "w") as logfile:
+            with redirect_stdout(logfile), redirect_stderr(logfile):
+                return self.__read_offline__(path, True, workdir, workers)
 
-                for path in tqdm(range(n_sim)):
-                    pathname = path_list[path]
-                    filename = os.path.join(pathname, "logger_2.csv")
-                    filename_V = os.path.join(pathname, "logger_6_Ve.csv")
-                    df = pd.read_csv(filename, index_col=None, header=0, delimiter="\t")
-                    path_split = filename.split("/")[len(filename.split("/")) - 2]
-                    if "e" in path_split:
-                        invalidIndices.append(path)
-                        continue
-                    if path_split.startswith("sweep") or path_split.startswith("DV"):
-                        start_nr = 1
-                    else:
-                        start_nr = 0
-                    params_split = path_split.split("_")[start_nr : nr_of_params + 1]
-                    param_file = list(
-                        map(lambda x: round(float(x.split("-")[1]), 3), params_split)
+    @timeit
+    def read_offline_store(self, path: str, store, workdir, workers: int = None):
+        """Parses all simulations matched by path straight into the memory-mapped
+        arrays of a DatasetStore instead of RAM.
+        """
+        with open(os.path.join(workdir, "log_read_offline.txt"), "w") as logfile:
+            with redirect_stdout(logfile), redirect_stderr(logfile):
+                spatial = bool(getattr(self.config, "spatial", False))
+                loggers = LoggerContext.loggers_2d if spatial else LoggerContext.loggers
+                path_list, params, dropped, nr_of_paths = self.__select__(path, spatial)
+                shape = (len(path_list), *self.sim_shape(spatial=spatial))
+                print(
+                    "Projected dataset size: {:.3f} GB".format(
+                        self.footprint(len(path_list), spatial) / 2**30
                     )
+                )
+                dfs, invalidIndices = self.__read_all__(
+                    self.get_simulation_2d if spatial else self.get_simulation,
+                    path_list,
+                    shape,
+                    self.sim_dtype(spatial),
+                    workers,
+                    out=store.create(shape, self.sim_dtype(spatial)),
+                )
+                dfs.flush()
+                dropped["parse error"] += len(invalidIndices)
+                self.report(nr_of_paths, +dropped)
+
+                selected = set(path_list)
+                store.finalize(
+                    path_list,
+                    params,
+                    invalidIndices,
+                    stats=[logger_stat(x, loggers) for x in path_list],
+                    rejected={
+                        x: logger_stat(x, loggers)
+                        for x in glob.glob(path)
+                        if x not in selected
+                    },
+                )
+                print("Read data in the form of: ", store.shape)
 
-                    df_tar = df["celltype.target.size"].values[:, np.newaxis][
-                        self.config.cut_off_start
-                        + 1 : self.config.timesteps
-                        - self.config.cut_off_end
-                    ]
-                    df_inf = df["celltype.infected.size"].values[:, np.newaxis][
-                        self.config.cut_off_start
-                        + 1 : self.config.timesteps
-                        - self.config.cut_off_end
-                    ]
-                    df_cells = np.append(df_tar, df_inf, axis=1)
-                    try:
-                        df_V = self.calculate_V(filename_V)
-                        I_volume = self.calculate_volume(pathname)[
-                            self.config.cut_off_start
-                            + 1 : self.config.timesteps
-                            - self.config.cut_off_end
-                        ]
-                    except Exception as error:
-                        invalidIndices.append(path)
-                        continue
-
-                    if (
-                        np.any(df_inf < 1)
-                        or np.any(np.asarray(param_file) > 1)
-                        or len(df_inf)
-                        != (
-                            self.config.timesteps
-                            - 1
-                            - self.config.cut_off_start
-                            - self.config.cut_off_end
+    @timeit
+    def read_offline_records(
+        self, path: str, records, workdir, workers: int = None, shard_size=1024
+    ):
+        """Parses all simulations matched by path into the shards of a RecordStore,
+        one shard of shard_size simulations at a time."""
+        with open(os.path.join(workdir, "log_read_offline.txt"), "w") as logfile:
+            with redirect_stdout(logfile), redirect_stderr(logfile):
+                spatial = bool(getattr(self.config, "spatial", False))
+                path_list, params, dropped, nr_of_paths = self.__select__(path, spatial)
+                records.create(self.sim_shape(spatial), self.sim_dtype(spatial))
+
+                held = self.holdout(params)
+                if len(held) > 0:
+                    # the validation set is kept apart from the shards
+                    dfs, invalidIndices = self.__read_all__(
+                        self.get_simulation_2d if spatial else self.get_simulation,
+                        [path_list[i] for i in held],
+                        (len(held), *self.sim_shape(spatial)),
+                        self.sim_dtype(spatial),
+                        workers,
+                    )
+                    dropped["parse error"] += len(invalidIndices)
+                    records.write_validation(
+                        *self.__compact__(dfs, params[held], invalidIndices)
+                    )
+                    training = np.setdiff1d(np.arange(len(path_list)), held)
+                    path_list = [path_list[i] for i in training]
+                    params = params[training]
+
+                for start in range(0, len(path_list), shard_size):
+                    shard_paths = path_list[start : start + shard_size]
+                    dfs, invalidIndices = self.__read_all__(
+                        self.get_simulation_2d if spatial else self.get_simulation,
+                        shard_paths,
+                        (len(shard_paths), *self.sim_shape(spatial)),
+                        self.sim_dtype(spatial),
+                        workers,
+                    )
+                    dropped["parse error"] += len(invalidIndices)
+                    records.write_shard(
+                        *self.__compact__(
+                            dfs, params[start : start + shard_size], invalidIndices
                         )
-                    ):
-                        invalidIndices.append(path)
-                        continue
-                    params[path] = param_file
-                    dfs[path] = np.append(
-                        np.append(df_cells, df_V, axis=1), I_volume, axis=1
                     )
-
-                dfs = np.delete(dfs, invalidIndices, axis=0)
-                params = np.delete(params, invalidIndices, axis=0)
-                print("Read data in the form of: ", dfs.shape)
-
-                return dfs, params
+                self.report(nr_of_paths, +dropped)
+                records.finalize(+dropped)
+                print("Read data in the form of: ", records.open(), records.shape)
 
     @timeit
-    def read_offline_data_2d(self, path: str, workdir):
+    def refresh_offline_store(self, path: str, store, workdir, workers: int = None):
+        """Brings a DatasetStore up to date with the simulations matched by path.
+        Only directories which are new or whose loggers changed since the store was
+        written are checked and parsed, their rows are appended. Rows of removed or
+        changed simulations are marked stale, i.e. invalid. Stores of another config
+        are read from scratch.
+        """
+        meta = store.read_meta()
+        if (
+            meta is None
+            or meta["config_hash"] != store.config_hash()
+            or meta.get("stats") is None
+        ):
+            return self.read_offline_store(path, store, workdir, workers)
+
         with open(os.path.join(workdir, "log_read_offline.txt"), "w") as logfile:
             with redirect_stdout(logfile), redirect_stderr(logfile):
-                path_list = glob.glob(path)
-                nr_of_params = self.config.param_nr
-
-                n_sim = len(path_list)
-                dfs = np.empty(
-                    (
-                        n_sim,
-                        self.config.grid_size,
-                        self.config.grid_size,
-                        (
-                            self.config.timesteps
-                            - self.config.cut_off_end
-                            - self.config.cut_off_start
-                            - 1
-                        ),  # TODO: Zeit kürzen
-                        3,
-                    ),
-                    dtype=np.float32,
+                spatial = bool(getattr(self.config, "spatial", False))
+                loggers = LoggerContext.loggers_2d if spatial else LoggerContext.loggers
+                current = {x: list(logger_stat(x, loggers)) for x in glob.glob(path)}
+                rows = {x: i for i, x in enumerate(meta["paths"])}
+                stale = [
+                    i
+                    for x, i in rows.items()
+                    if meta["valid"][i] and current.get(x) != meta["stats"][i]
+                ]
+                new_paths = [
+                    x
+                    for x, stat in current.items()
+                    if (x in rows and stat != meta["stats"][rows[x]])
+                    or (x not in rows and meta["rejected"].get(x) != stat)
+                ]
+
+                if len(stale) == 0 and len(new_paths) == 0:
+                    print("Read data in the form of: ", tuple(meta["shape"]))
+                    return
+
+                store.open()
+                path_list, params, dropped, nr_of_paths = self.__select__(
+                    path, spatial, new_paths
                 )
-                params = np.empty((n_sim, nr_of_params), dtype=np.float32)
                 invalidIndices = []
-
-                for path in tqdm(range(n_sim)):
-                    pathname = path_list[path]
-                    path_split = pathname.split("/")[len(pathname.split("/")) - 1]
-                    if "e" in path_split:
-                        invalidIndices.append(path)
-                        continue
-
-                    params_dict = {
-                        i.split("-")[0]: round(float(i.split("-")[1]), 3)
-                        for i in path_split.split("_")
-                        if i.split("-")[0] in self.config.prior_names
-                    }
-
-                    v = self.calculate_V_2d(pathname).transpose((1, 2, 0))[
-                        :,
-                        :,
-                        self.config.cut_off_start
-                        + 1 : self.config.timesteps
-                        - self.config.cut_off_end,
-                    ]
-                    I = self.get_cell_states_2d(pathname).transpose((1, 2, 0))[
-                        :,
-                        :,
-                        self.config.cut_off_start
-                        + 1 : self.config.timesteps
-                        - self.config.cut_off_end,
-                    ]
-                    id = self.get_ids_2d(pathname).transpose((1, 2, 0))[
-                        :,
-                        :,
-                        self.config.cut_off_start
-                        + 1 : self.config.timesteps
-                        - self.config.cut_off_end,
-                    ]
-                    params[path] = list(params_dict.values())
-                    dfs[path] = np.concatenate(
-                        (
-                            np.expand_dims(v, axis=-1),
-                            np.expand_dims(id, axis=-1),
-                            np.expand_dims(I, axis=-1),
-                        ),
-                        axis=-1,
+                if len(path_list) > 0:
+                    new_rows = store.append(len(path_list))
+                    dfs, invalidIndices = self.__read_all__(
+                        self.get_simulation_2d if spatial else self.get_simulation,
+                        path_list,
+                        new_rows.shape,
+                        new_rows.dtype,
+                        workers,
+                        out=new_rows,
                     )
-
-                dfs = np.delete(dfs, invalidIndices, axis=0)
-                params = np.delete(params, invalidIndices, axis=0)
-                print("Read data in the form of: ", dfs.shape)
-                return dfs, params
+                    dfs.flush()
+                dropped["parse error"] += len(invalidIndices)
+                self.report(nr_of_paths, +dropped)
+                print("Stale simulations: ", len(stale))
+
+                selected = set(path_list)
+                rejected = {
+                    x: stat
+                    for x, stat in meta["rejected"].items()
+                    if current.get(x) == stat
+                }
+                rejected.update({x: current[x] for x in new_paths if x not in selected})
+                nr_of_rows = len(meta["paths"])
+                store.finalize(
+                    meta["paths"] + path_list,
+                    np.concatenate(
+                        (np.asarray(meta["params"], dtype=np.float32), params)
+                    ),
+                    sorted(
+                        set(np.flatnonzero(np.logical_not(meta["valid"])))
+                        | set(stale)
+                        | {nr_of_rows + i for i in invalidIndices}
+                    ),
+                    stats=meta["stats"] + [current[x] for x in path_list],
+                    rejected=rejected,
+                )
+                print("Read data in the form of: ", store.shape)
 
     def prepare_input(self, forward_dict):
         """Function to self.configure the simulated quantities (i.e., simulator outputs)
@@ -239,11 +665,18 @@ class DataReader:
         out_dict = {}
 
         # Convert data to logscale
+        sim_data = np.asarray(forward_dict["sim_data"])
+        if sim_data.dtype.names is not None:
+            # spatial records, the channels become the last axis
+            sim_data = np.stack(
+                [sim_data[name].astype(np.float32) for name in sim_data.dtype.names],
+                axis=-1,
+            )
 
-        logdata = np.log1p(forward_dict["sim_data"]).astype(np.float64)
+        logdata = np.log1p(sim_data).astype(np.float64)
 
         # Extract prior draws and z-standardize with previously computed means
-        params = forward_dict["prior_draws"].astype(np.float64)
+        params = np.asarray(forward_dict["prior_draws"]).astype(np.float64)
         params = (params - self.prior_means) / self.prior_stds
 
         # Remove a batch if it contains nan, inf or -inf
@@ -254,28 +687,18 @@ class DataReader:
         out_dict["parameters"] = params
         return out_dict
 
-    def __get_2d_data__(self, path: str, logger: str, to_np: bool = True):
-        logger_data = os.path.join(path, logger)
-        df = pd.read_csv(logger_data, sep="\t")
-        df = df[df[str(self.config.grid_size)] != self.config.grid_size].drop(
-            columns=str(self.config.grid_size)
-        )
-        if to_np:
-            df = df.to_numpy().reshape(
-                self.config.timesteps + 1, self.config.grid_size, self.config.grid_size
-            )
-        return df
-
-    def calculate_V_2d(self, path: str, to_np: bool = True):
-        Ve = self.__get_2d_data__(path, "logger_6_Ve.csv", to_np=to_np)
-        return Ve
+    @cached("logger_6_Ve.csv")
+    def calculate_V_2d(self, path, to_np: bool = True):
+        context = self.context(path)
+        return context.ve if to_np else context.ve_frame.copy()
 
-    def get_ids_2d(self, path: str, to_np: bool = True):
-        Ids = self.__get_2d_data__(path, "logger_4_cell.id.csv", to_np=to_np)
-        return Ids
+    @cached("logger_4_cell.id.csv")
+    def get_ids_2d(self, path, to_np: bool = True):
+        context = self.context(path)
+        return context.ids if to_np else context.ids_frame.copy()
 
-    def get_cell_states(self, path: str, to_np: bool = True):
-        cell_state = pd.read_csv(os.path.join(path, "logger_1.csv"), sep="\t")
+    def get_cell_states(self, path, to_np: bool = True):
+        cell_state = self.context(path).cell_states.copy()
         if to_np:
             cell_state = (
                 cell_state.drop(columns="time")
@@ -284,26 +707,21 @@ class DataReader:
             )
         return cell_state
 
-    def get_cell_states_2d(self, path: str, to_np: bool = True):
-        id = self.get_ids_2d(path, False)
-        time = np.repeat(range(0, self.config.cell_nr), self.config.grid_size)
-        id["time"] = time
-        cs = []
-
-        cell_state = self.get_cell_states(path, False)
-        for t in id["time"].unique():
-            dict = (
-                cell_state[cell_state["time"] == t]
-                .drop(columns="time")
-                .set_index("cell.id")
-                .to_dict()["V"]
-            )
-
-            cs.append(id[id["time"] == t].drop(columns="time").replace(dict))
-
-        cs = pd.concat(cs)
-        if to_np:
-            cs = cs.to_numpy().reshape(
-                self.config.timesteps + 1, self.config.grid_size, self.config.grid_size
+    @cached("logger_1.csv", "logger_4_cell.id.csv")
+    def get_cell_states_2d(self, path, to_np: bool = True):
+        context = self.context(path)
+        cell_state = context.cell_states
+        cs = ParseKernels.cell_states_2d(
+            context.ids,
+            cell_state["time"].to_numpy(),
+            cell_state["cell.id"].to_numpy(),
+            cell_state["V"].to_numpy(),
+        )
+        if not to_np:
+            id = context.ids_frame
+            cs = pd.DataFrame(
+                cs.reshape(-1, self.config.grid_size),
+                index=id.index,
+                columns=id.columns,
             )
         return cs
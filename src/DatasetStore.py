@@ -0,0 +1,127 @@
+import io
+import os
+import numpy as np
+from OfflineStore import OfflineStore
+from Utility import atomic_path
+
+
+class DatasetStore(OfflineStore):
+    """Offline dataset as a memory-mapped .npy file with a json header."""
+
+    # bumped whenever the layout of data.npy changes
+    format_version = 2
+    data_file = "data.npy"
+
+    def create(self, shape, dtype):
+        """Allocates the memory-mapped array a reader fills in place."""
+        os.makedirs(self.path, exist_ok=True)
+        self.remove_meta()
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        data = np.lib.format.open_memmap(
+            os.path.join(self.path, self.data_file),
+            mode="w+",
+            dtype=self.dtype,
+            shape=shape,
+        )
+        return data
+
+    def append(self, nr_of_rows):
+        """Grows the memory-mapped array of a finalized store by nr_of_rows and
+        returns the array of the new rows for a reader to fill in place. The npy
+        header is rewritten in place if it keeps its length, which numpy's header
+        padding allows for a growing first axis, the existing rows are copied
+        otherwise.
+        """
+        self.remove_meta()
+        data_path = os.path.join(self.path, self.data_file)
+        data = np.load(data_path, mmap_mode="r")
+        nr_of_old_rows, offset, dtype = len(data), data.offset, data.dtype
+        shape = (nr_of_old_rows + nr_of_rows, *data.shape[1:])
+        del data
+
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(
+            header,
+            {
+                "descr": np.lib.format.dtype_to_descr(dtype),
+                "fortran_order": False,
+                "shape": shape,
+            },
+        )
+        if len(header.getvalue()) == offset:
+            with open(data_path, "r+b") as f:
+                f.write(header.getvalue())
+                f.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+        else:
+            old = np.load(data_path, mmap_mode="r")
+            with atomic_path(data_path) as tmp_path:
+                new = np.lib.format.open_memmap(
+                    tmp_path, mode="w+", dtype=dtype, shape=shape
+                )
+                for start in range(0, nr_of_old_rows, 1024):
+                    stop = min(start + 1024, nr_of_old_rows)
+                    new[start:stop] = old[start:stop]
+                new.flush()
+                del old, new
+
+        self.shape = shape
+        self.dtype = dtype
+        return np.load(data_path, mmap_mode="r+")[nr_of_old_rows:]
+
+    def finalize(self, path_list, params, invalidIndices, stats=None, rejected=None):
+        """Writes the header of the store. stats holds the (size, mtime) of the
+        loggers of every row, rejected the stats of the simulations the reader
+        dropped before parsing, both are used to refresh the store.
+        """
+        valid = np.ones(len(path_list), dtype=bool)
+        valid[invalidIndices] = False
+        params = np.where(valid[:, np.newaxis], params, 0)
+        self.write_meta(
+            {
+                "shape": list(self.shape),
+                "dtype": np.lib.format.dtype_to_descr(self.dtype),
+                "prior_names": list(self.config.prior_names),
+                "paths": list(path_list),
+                "valid": valid.tolist(),
+                "params": params.tolist(),
+                "stats": [list(x) for x in stats] if stats is not None else None,
+                "rejected": rejected or {},
+            }
+        )
+
+    def open(self):
+        """Returns the memory-mapped simulations, all parameters and the indices of
+        the valid simulations.
+        """
+        meta = self.read_meta()
+        data = np.load(os.path.join(self.path, self.data_file), mmap_mode="r")
+        self.shape = data.shape
+        self.dtype = data.dtype
+        params = np.asarray(meta["params"], dtype=np.float32)
+        return data, params, np.flatnonzero(meta["valid"])
+
+
+class StoreSampler:
+    """Batches of a shuffled pass over the valid simulations of a DatasetStore."""
+
+    def __init__(self, data, params, indices, seed=None):
+        self.data = data
+        self.params = params
+        self.indices = np.asarray(indices)
+        self.rng = np.random.default_rng(seed)
+        self.order = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __call__(self, batch_size, **kwargs):
+        if len(self.order) < batch_size:
+            self.order = np.append(self.order, self.rng.permutation(self.indices))
+        batch, self.order = self.order[:batch_size], self.order[batch_size:]
+        # sorted indices read the memory map front to back
+        batch = np.sort(batch)
+        return {
+            "prior_draws": self.params[batch],
+            "sim_data": np.asarray(self.data[batch]),
+        }
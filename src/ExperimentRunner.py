@@ -2,6 +2,7 @@ import argparse
 import sys, os
 import importlib.util
 import time
+import numpy as np
 
 parser = argparse.ArgumentParser(
     prog="ExperimentRunner",
@@ -31,6 +32,11 @@ sys.path.append(os.path.abspath(os.path.join(config.BayesFlowPath)))
 from DataReader import DataReader
 from SimulationRunner import SimulationRunner
 from ResultLogger import ResultLogger
+from DatasetStore import DatasetStore, StoreSampler
+from RecordStore import RecordStore, RecordSampler
+from GraphConfigurator import GraphConfigurator
+from SimulationPrefetcher import SimulationPrefetcher
+from Metrics import metrics
 from functools import partial
 import tensorflow as tf
 from contextlib import redirect_stdout, redirect_stderr
@@ -46,23 +52,50 @@ import bayesflow.diagnostics as diag
 # tf.config.experimental.set_memory_growth(physical_devices[1], True)
 
 
+def timed_configurator(configurator):
+    """configurator recording its own time and, as the trainer configures every
+    batch once, the time per training step."""
+    if not metrics.enabled:
+        return configurator
+
+    def configure(forward_dict, **kwargs):
+        metrics.tick("training.step")
+        with metrics.time("configurator"):
+            return configurator(forward_dict, **kwargs)
+
+    return configure
+
+
 if __name__ == "__main__":
     with open(os.path.join(workdir, "log_training.txt"), "w") as logfile:
         with redirect_stdout(logfile), redirect_stderr(logfile):
+            metrics.enabled = getattr(config, "metrics", False)
             logfile.write("Initialize prior")
             prior = Prior(prior_fun=config.prior_func, param_names=config.prior_names)
             prior_means, prior_stds = prior.estimate_means_and_stds()
             dataReader = DataReader(
                 config, prior_means=prior_means, prior_stds=prior_stds
             )
+            if getattr(config, "graph_configurator", False):
+                configurator = GraphConfigurator(prior_means, prior_stds)
+            else:
+                configurator = dataReader.prepare_input
             logfile.write("Initialize generative model")
             simulationRunner = SimulationRunner(config, workdir, dataReader)
 
-            if config.spatial == None or not config.spatial:
-                simulationFuc = partial(simulationRunner.run)
+            if getattr(config, "simulation_workers", 1) != 1:
+                # whole prior draws are simulated concurrently
+                if config.spatial == None or not config.spatial:
+                    simulationFuc = partial(simulationRunner.run_batch)
+                else:
+                    simulationFuc = partial(simulationRunner.run_2d_batch)
+                simulator = Simulator(batch_simulator_fun=simulationFuc)
             else:
-                simulationFuc = partial(simulationRunner.run_2d)
-            simulator = Simulator(simulator_fun=simulationFuc)
+                if config.spatial == None or not config.spatial:
+                    simulationFuc = partial(simulationRunner.run)
+                else:
+                    simulationFuc = partial(simulationRunner.run_2d)
+                simulator = Simulator(simulator_fun=simulationFuc)
             model = GenerativeModel(prior, simulator, name=config.model_name)
 
             logfile.write("Initialize amortizer")
@@ -80,40 +113,112 @@ if __name__ == "__main__":
             trainer = Trainer(
                 amortizer=amortizer,
                 generative_model=model,
-                configurator=dataReader.prepare_input,
+                configurator=timed_configurator(configurator),
                 checkpoint_path=os.path.join(workdir, config.checkpoints),
                 optional_stopping=config.optional_stopping,
             )
             logfile.write("Initialization finished")
+            validation_sims = None
 
             match config.training_mode:
                 case "offline":
                     logfile.write("Start reading data")
-                    data, params = dataReader.read_offline_data_2d(
-                        os.path.join(config.data_path, config.folder + "/*"), workdir
-                    )
+                    data_glob = os.path.join(config.data_path, config.folder + "/*")
+                    if getattr(config, "offline_records", None):
+                        records = RecordStore(config, config.offline_records)
+                        if not records.is_current():
+                            dataReader.read_offline_records(
+                                data_glob,
+                                records,
+                                workdir,
+                                shard_size=getattr(config, "records_per_shard", 1024),
+                            )
+                        indices = np.arange(records.open())
+                        validation_sims = records.validation()
+                    elif getattr(config, "offline_store", None):
+                        store = DatasetStore(config, config.offline_store)
+                        if getattr(config, "offline_refresh", False):
+                            dataReader.refresh_offline_store(data_glob, store, workdir)
+                        elif not store.is_current():
+                            dataReader.read_offline_store(data_glob, store, workdir)
+                        data, params, indices = store.open()
+                    else:
+                        data, params = dataReader.read_offline_data_2d(
+                            data_glob, workdir
+                        )
+                        indices = np.arange(len(data))
+                    if not getattr(config, "offline_records", None):
+                        # validation simulations are held out of the training indices
+                        held = dataReader.holdout(params[indices])
+                        if len(held) > 0:
+                            validation_sims = {
+                                "prior_draws": params[indices[held]],
+                                "sim_data": np.asarray(data[indices[held]]),
+                            }
+                            indices = np.delete(indices, held)
                     logfile.write("Finished reading data")
                     logfile.write("Start training")
                     start_time = time.time()
-                    h = trainer.train_offline(
+                    # spatial records are converted to float per batch, so batches
+                    # are served by a sampler instead of a float copy of the dataset
+                    if getattr(config, "offline_records", None):
+                        trainer.generative_model = RecordSampler(
+                            records,
+                            config.batch_size,
+                            getattr(config, "shuffle_buffer", 4096),
+                            configurator.map
+                            if isinstance(configurator, GraphConfigurator)
+                            else None,
+                        )
+                    else:
+                        trainer.generative_model = StoreSampler(data, params, indices)
+                    h = trainer.train_online(
                         epochs=config.epochs,
+                        iterations_per_epoch=len(indices) // config.batch_size,
                         batch_size=config.batch_size,
-                        simulations_dict={"prior_draws": params, "sim_data": data},
                     )
                     end_time = time.time()
                     elapsed_time = time.time() - start_time
                     logfile.write("Finished training")
                     logfile.write(str(elapsed_time))
                 case "online":
-                    h = trainer.train_online(
-                        epochs=config.epochs,
-                        iterations_per_epoch=config.iter_per_epoch,
-                        batch_size=config.batch_size,
-                    )
+                    if getattr(config, "prefetch_batches", 0) > 0:
+                        # simulate the next batches while the network trains
+                        prefetcher = SimulationPrefetcher(
+                            model,
+                            configurator,
+                            config.batch_size,
+                            depth=config.prefetch_batches,
+                            workers=getattr(config, "prefetch_workers", 1),
+                        )
+                        trainer.generative_model = prefetcher
+                        trainer.configurator = timed_configurator(
+                            prefetcher.configurator
+                        )
+                        with prefetcher:
+                            h = trainer.train_online(
+                                epochs=config.epochs,
+                                iterations_per_epoch=config.iter_per_epoch,
+                                batch_size=config.batch_size,
+                            )
+                        trainer.generative_model = model
+                        trainer.configurator = timed_configurator(configurator)
+                    else:
+                        h = trainer.train_online(
+                            epochs=config.epochs,
+                            iterations_per_epoch=config.iter_per_epoch,
+                            batch_size=config.batch_size,
+                        )
                 case _:
                     logfile.write("Unbekannter Trainingsmodus")
                     sys.exit()
 
+            if simulationRunner.simulationStore is not None:
+                logfile.write(
+                    "Simulation store: "
+                    + str(simulationRunner.simulationStore.counters)
+                )
+
             print("Plot results")
             results = ResultLogger(
                 workdir=workdir,
@@ -125,5 +230,9 @@ if __name__ == "__main__":
                 model=model,
                 configurator=dataReader.prepare_input,
                 amortizer=amortizer,
+                simulationRunner=simulationRunner,
+                validation_sims=validation_sims,
             )
             results.create_plots()
+            if metrics.enabled:
+                metrics.export(workdir)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import os
+import random
+import sys
+import time
+import xml.etree.ElementTree as ET
+import zlib
+import SyntheticMorpheus
+
+# FAKE_MORPHEUS_SLEEP: seconds a run takes, "a:b" samples them uniformly
+# FAKE_MORPHEUS_GRID_SIZE, FAKE_MORPHEUS_CELL_NR: override the model's lattice size
+# and the default of 51 cells
+environment = "FAKE_MORPHEUS_"
+
+
+def parse_arguments(argv):
+    """Model file, output directory and parameters of a morpheus command line
+    "-f model.xml -o OUT -key=value ..."."""
+    model, out, params = None, os.getcwd(), {}
+    arguments = iter(argv)
+    for argument in arguments:
+        if argument == "-f":
+            model = next(arguments)
+        elif argument == "-o":
+            out = next(arguments)
+        elif argument.startswith("-") and "=" in argument:
+            key, value = argument[1:].split("=", 1)
+            params[key] = value
+        else:
+            raise ValueError("unknown argument " + argument)
+    if model is None:
+        raise ValueError("no model given, use -f model.xml")
+    return model, out, params
+
+
+def model_settings(model):
+    """Lattice size and stop time of a Morpheus model, None if not given."""
+    root = ET.parse(model).getroot()
+    grid_size, stop_time = None, None
+    size = root.find("Space/Lattice/Size")
+    if size is not None:
+        grid_size = int(float(size.get("value").replace(",", " ").split()[0]))
+    stop = root.find("Time/StopTime")
+    if stop is not None:
+        stop_time = int(float(stop.get("value")))
+    return grid_size, stop_time
+
+
+def sleep_duration(spec, rng):
+    low, _, high = spec.partition(":")
+    return rng.uniform(float(low), float(high)) if high else float(low)
+
+
+def main(argv):
+    model, out, params = parse_arguments(argv)
+    grid_size, stop_time = model_settings(model)
+    grid_size = int(os.environ.get(environment + "GRID_SIZE", grid_size or 10))
+    cell_nr = int(os.environ.get(environment + "CELL_NR", 51))
+    timesteps = stop_time if stop_time is not None else 50
+    # the same parameters give the same simulation
+    seed = zlib.crc32(repr(sorted(params.items())).encode())
+
+    print("Fake Morpheus: {} -> {} {}".format(model, out, params), flush=True)
+    time.sleep(
+        sleep_duration(os.environ.get(environment + "SLEEP", "0"), random.Random(seed))
+    )
+    SyntheticMorpheus.write_simulation(out, grid_size, cell_nr, timesteps, seed)
+    # Morpheus plots the last timestep after all loggers are written
+    open(os.path.join(out, "plot_{:05d}.png".format(timesteps)), "wb").close()
+    print("Simulation finished", flush=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,43 @@
+import numpy as np
+import tensorflow as tf
+
+
+class GraphConfigurator:
+    """DataReader.prepare_input as float32 TensorFlow ops: the log transform of the
+    simulations and the z-standardization of the parameters run in one traced graph
+    instead of NumPy float64 copies of every batch. Spatial records are handed over
+    channel by channel in their compact dtypes and stacked in the graph. Can also be
+    mapped over a tf.data pipeline, see RecordStore.dataset.
+    """
+
+    def __init__(self, prior_means, prior_stds):
+        self.prior_means = tf.constant(np.asarray(prior_means), dtype=tf.float32)
+        self.prior_stds = tf.constant(np.asarray(prior_stds), dtype=tf.float32)
+        self.configure = tf.function(self.__configure__)
+
+    def __configure__(self, channels, prior_draws):
+        sim_data = [tf.cast(channel, tf.float32) for channel in channels]
+        sim_data = sim_data[0] if len(sim_data) == 1 else tf.stack(sim_data, axis=-1)
+        params = tf.cast(prior_draws, tf.float32)
+        return {
+            "summary_conditions": tf.math.log1p(sim_data),
+            "parameters": (params - self.prior_means) / self.prior_stds,
+        }
+
+    def __call__(self, forward_dict, **kwargs):
+        """Configurator for the trainer, batches already configured in a tf.data
+        pipeline pass through."""
+        if "sim_data" not in forward_dict:
+            return forward_dict
+        sim_data = forward_dict["sim_data"]
+        if isinstance(sim_data, np.ndarray) and sim_data.dtype.names is not None:
+            channels = [
+                np.ascontiguousarray(sim_data[name]) for name in sim_data.dtype.names
+            ]
+        else:
+            channels = [sim_data]
+        return self.configure(channels, forward_dict["prior_draws"])
+
+    def map(self, batch):
+        """tf.data map function for batches {"prior_draws", "sim_data"}."""
+        return self.__configure__([batch["sim_data"]], batch["prior_draws"])
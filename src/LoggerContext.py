@@ -0,0 +1,88 @@
+import functools
+import os
+import numpy as np
+import pandas as pd
+from Metrics import metrics
+
+
+class LoggerContext:
+    """Parses the Morpheus loggers of one simulation directory on first use and keeps
+    the results, so every logger is read at most once no matter how many quantities
+    are derived from it. Column loggers only load the columns that are used, matrix
+    loggers are parsed straight into arrays; the frames are only built on request.
+    """
+
+    # loggers the 1d observables and the spatial tensors are computed from
+    loggers = [
+        "logger_1.csv",
+        "logger_2.csv",
+        "logger_4_cell.id.csv",
+        "logger_6_Ve.csv",
+    ]
+    loggers_2d = ["logger_1.csv", "logger_4_cell.id.csv", "logger_6_Ve.csv"]
+    population_columns = ["celltype.target.size", "celltype.infected.size"]
+    cell_state_columns = ["time", "cell.id", "V"]
+
+    def __init__(self, path: str, config, cacheable: bool = True):
+        self.path = path
+        self.config = config
+        # False for throwaway directories whose parses must not enter the parse cache
+        self.cacheable = cacheable
+
+    def __read_2d__(self, logger: str):
+        """(timesteps + 1, grid, grid) array of a matrix logger, which writes a header
+        line ("grid_size 0 1 ...") followed by one line per grid row and timestep.
+        """
+        grid_size = self.config.grid_size
+        with metrics.time("parse." + logger):
+            values = pd.read_csv(
+                os.path.join(self.path, logger),
+                sep="\t",
+                header=None,
+                usecols=range(1, grid_size + 1),
+            ).to_numpy()
+        return np.ascontiguousarray(
+            values.reshape(self.config.timesteps + 1, grid_size + 1, grid_size)[:, 1:]
+        )
+
+    def __read_2d_frame__(self, logger: str):
+        with metrics.time("parse." + logger):
+            df = pd.read_csv(os.path.join(self.path, logger), sep="\t")
+        return df[df[str(self.config.grid_size)] != self.config.grid_size].drop(
+            columns=str(self.config.grid_size)
+        )
+
+    @functools.cached_property
+    def population(self):
+        with metrics.time("parse.logger_2.csv"):
+            df = pd.read_csv(
+                os.path.join(self.path, "logger_2.csv"),
+                sep="\t",
+                usecols=self.population_columns,
+            )
+        return df[self.population_columns].to_numpy()
+
+    @functools.cached_property
+    def cell_states(self):
+        with metrics.time("parse.logger_1.csv"):
+            return pd.read_csv(
+                os.path.join(self.path, "logger_1.csv"),
+                sep="\t",
+                usecols=self.cell_state_columns,
+            )[self.cell_state_columns]
+
+    @functools.cached_property
+    def ve(self):
+        return self.__read_2d__("logger_6_Ve.csv")
+
+    @functools.cached_property
+    def ve_frame(self):
+        return self.__read_2d_frame__("logger_6_Ve.csv")
+
+    @functools.cached_property
+    def ids(self):
+        return self.__read_2d__("logger_4_cell.id.csv")
+
+    @functools.cached_property
+    def ids_frame(self):
+        return self.__read_2d_frame__("logger_4_cell.id.csv")
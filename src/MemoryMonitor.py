@@ -0,0 +1,100 @@
+import contextlib
+import json
+import os
+import resource
+import time
+import tracemalloc
+
+
+def current_rss():
+    """Resident set size of this process in bytes, None where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def reset_peak_rss():
+    """Resets the peak RSS of this process, False where the kernel does not allow it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """Peak resident set size in bytes since the last reset_peak_rss, None where
+    /proc is missing."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def workers_peak_rss():
+    """Largest peak resident set size of all terminated child processes so far in
+    bytes (ru_maxrss is in KB on Linux), it cannot be reset per phase."""
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+class MemoryMonitor:
+    """Records the memory of named phases, e.g. the check, read and compaction pass
+    of an offline reader: wall time, current and peak RSS of the process during the
+    phase (None where the peak cannot be reset), the largest peak RSS of the forked
+    workers since the process started, and with tracemalloc the traced and peak
+    traced memory of the phase with its largest allocation sites. A disabled monitor
+    records nothing.
+    """
+
+    def __init__(self, enabled: bool = True, top: int = 10):
+        self.enabled = enabled
+        self.top = top
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        reset = reset_peak_rss()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            traced, traced_peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            if started:
+                tracemalloc.stop()
+            self.phases.append(
+                {
+                    "phase": name,
+                    "seconds": time.perf_counter() - start_time,
+                    "rss": current_rss(),
+                    "peak_rss": peak_rss() if reset else None,
+                    "lifetime_peak_rss_workers": workers_peak_rss(),
+                    "traced": traced,
+                    "traced_peak": traced_peak,
+                    "top": [
+                        {"site": str(stat.traceback), "size": stat.size}
+                        for stat in snapshot.statistics("lineno")[: self.top]
+                    ],
+                }
+            )
+
+    def write(self, path: str, **info):
+        """Writes the recorded phases and info such as the projected footprint."""
+        if not self.enabled:
+            return
+        with open(path, "w") as f:
+            json.dump(dict(info, phases=self.phases), f, indent=2)
@@ -0,0 +1,138 @@
+import contextlib
+import csv
+import json
+import os
+import threading
+import time
+import numpy as np
+
+
+class Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.record(self.name, time.perf_counter() - self.start_time)
+
+
+class Metrics:
+    """Registry of counters, timers (seconds) and histograms (any values) shared by
+    the modules of an experiment. Samples are kept in lists and only summarized on
+    export, as json and csv with count, total, mean, p50, p95, p99 and max per name.
+    A disabled registry records nothing: time() hands out one reusable null context
+    and wrap() returns the function itself.
+    """
+
+    quantiles = [50, 95, 99]
+    null_context = contextlib.nullcontext()
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.timers = {}
+            self.histograms = {}
+            self.ticks = {}
+
+    def count(self, name: str, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.timers.setdefault(name, []).append(seconds)
+
+    def observe(self, name: str, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.histograms.setdefault(name, []).append(value)
+
+    def time(self, name: str):
+        """Context manager recording the seconds spent in its block as timer name."""
+        return Timer(self, name) if self.enabled else self.null_context
+
+    def tick(self, name: str):
+        """Records the seconds since the previous tick of name, e.g. per training
+        step when called once per step."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            previous = self.ticks.get(name)
+            self.ticks[name] = now
+            if previous is not None:
+                self.timers.setdefault(name, []).append(now - previous)
+
+    def wrap(self, name: str, func):
+        """func timed as timer name, func itself if the registry is disabled."""
+        if not self.enabled:
+            return func
+
+        def timed(*args, **kwargs):
+            with self.time(name):
+                return func(*args, **kwargs)
+
+        return timed
+
+    @classmethod
+    def statistics(cls, values):
+        values = np.asarray(values, dtype=float)
+        statistics = {
+            "count": len(values),
+            "total": float(values.sum()),
+            "mean": float(values.mean()),
+        }
+        for quantile, value in zip(cls.quantiles, np.percentile(values, cls.quantiles)):
+            statistics["p{}".format(quantile)] = float(value)
+        statistics["max"] = float(values.max())
+        return statistics
+
+    def summary(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "timers": {
+                    name: self.statistics(values)
+                    for name, values in self.timers.items()
+                },
+                "histograms": {
+                    name: self.statistics(values)
+                    for name, values in self.histograms.items()
+                },
+            }
+
+    def export(self, workdir: str, name: str = "metrics"):
+        """Writes the summary to workdir/name.json and workdir/name.csv."""
+        summary = self.summary()
+        with open(os.path.join(workdir, name + ".json"), "w") as f:
+            json.dump(summary, f, indent=2)
+
+        columns = ["kind", "name", "count", "total", "mean"]
+        columns += ["p{}".format(x) for x in self.quantiles] + ["max"]
+        with open(os.path.join(workdir, name + ".csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, columns)
+            writer.writeheader()
+            for counter, value in summary["counters"].items():
+                writer.writerow({"kind": "counter", "name": counter, "count": value})
+            for kind in ["timers", "histograms"]:
+                for metric, statistics in summary[kind].items():
+                    writer.writerow(dict(statistics, kind=kind[:-1], name=metric))
+        return summary
+
+
+# registry of the running experiment, enabled by ExperimentRunner
+metrics = Metrics()
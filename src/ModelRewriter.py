@@ -0,0 +1,80 @@
+import hashlib
+import os
+import re
+import threading
+import xml.etree.ElementTree as ET
+from Utility import atomic_write
+
+
+class ModelRewriter:
+    """Derives a model file from a Morpheus model which only writes the loggers a run
+    consumes. Plotters are removed. Morpheus numbers the loggers by their position
+    in the Analysis section, so unused loggers are kept (the remaining logger files
+    keep their names) but only log once at the end of the simulation. Derived models
+    are written once per model and logger selection and reused by every run.
+    """
+
+    plotters = ["Gnuplotter", "VtkPlotter", "ModelGraph"]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.models = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def logger_numbers(loggers):
+        """Logger numbers of logger file names such as logger_4_cell.id.csv."""
+        return sorted(
+            {int(re.match(r"logger_(\d+)", logger).group(1)) for logger in loggers}
+        )
+
+    def rewrite(self, model: str, loggers):
+        """Parsed model with the plotters removed and the loggers not in loggers
+        logging at the stop time only."""
+        parser = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True))
+        tree = ET.parse(model, parser)
+        root = tree.getroot()
+        analysis = root.find("Analysis")
+        if analysis is None:
+            return tree
+
+        for plotter in self.plotters:
+            for element in analysis.findall(plotter):
+                analysis.remove(element)
+
+        used = self.logger_numbers(loggers)
+        stop_time = root.find("Time/StopTime")
+        for number, logger in enumerate(analysis.findall("Logger"), start=1):
+            for plots in logger.findall("Plots"):
+                logger.remove(plots)
+            if number not in used and stop_time is not None:
+                logger.set("time-step", stop_time.get("value"))
+        return tree
+
+    def file(self, model: str, loggers):
+        key = hashlib.sha1()
+        with open(model, "rb") as f:
+            key.update(f.read())
+        key.update(repr(self.logger_numbers(loggers)).encode())
+        name, extension = os.path.splitext(os.path.basename(model))
+        return os.path.join(
+            self.path, "{}-{}{}".format(name, key.hexdigest(), extension)
+        )
+
+    def derive(self, model: str, loggers):
+        """Path of the derived model, written on first use."""
+        stat = os.stat(model)
+        model_key = (model, stat.st_mtime_ns, stat.st_size, tuple(sorted(loggers)))
+        with self.lock:
+            if model_key in self.models:
+                return self.models[model_key]
+
+            derived = self.file(model, loggers)
+            if not os.path.exists(derived):
+                os.makedirs(self.path, exist_ok=True)
+                with atomic_write(derived) as f:
+                    self.rewrite(model, loggers).write(
+                        f, encoding="UTF-8", xml_declaration=True
+                    )
+            self.models[model_key] = derived
+            return derived
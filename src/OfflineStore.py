@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+from Utility import atomic_write
+
+
+class OfflineStore:
+    """Json header and config hash shared by the on-disk offline datasets."""
+
+    format_version = 1
+    meta_file = "meta.json"
+    config_fields = [
+        "data_path",
+        "folder",
+        "prior_names",
+        "param_nr",
+        "spatial",
+        "viral_load_dtype",
+        "grid_size",
+        "cell_nr",
+        "timesteps",
+        "cut_off_start",
+        "cut_off_end",
+        "offline_manifest",
+        "offline_param_ranges",
+    ]
+
+    def __init__(self, config, path: str):
+        self.config = config
+        self.path = path
+        self.shape = None
+        self.dtype = None
+
+    def config_hash(self):
+        config_hash = hashlib.sha1()
+        config_hash.update(repr(self.format_version).encode())
+        for field in self.config_fields:
+            config_hash.update(repr(getattr(self.config, field, None)).encode())
+        return config_hash.hexdigest()
+
+    def read_meta(self):
+        meta_path = os.path.join(self.path, self.meta_file)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def is_current(self):
+        meta = self.read_meta()
+        return meta is not None and meta["config_hash"] == self.config_hash()
+
+    def remove_meta(self):
+        """Marks the store incomplete until write_meta is called again."""
+        meta_path = os.path.join(self.path, self.meta_file)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+    def write_meta(self, meta):
+        """Writes the header with the current config hash."""
+        with atomic_write(os.path.join(self.path, self.meta_file), "w") as f:
+            json.dump(dict(meta, config_hash=self.config_hash()), f)
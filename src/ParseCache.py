@@ -0,0 +1,95 @@
+import functools
+import hashlib
+import os
+import numpy as np
+from Utility import atomic_write
+
+
+class ParseCache:
+    """Persistent cache for quantities parsed from the Morpheus loggers of a
+    simulation directory. Entries are stored as .npy files and keyed by the
+    directory, the parsed quantity, the size and mtime of the loggers it is
+    computed from and the config fields which affect parsing, so changed outputs
+    or configs never hit stale entries.
+    """
+
+    config_fields = [
+        "grid_size",
+        "timesteps",
+        "cut_off_start",
+        "cut_off_end",
+        "cell_nr",
+    ]
+
+    def __init__(self, config, cache_dir=None):
+        self.config = config
+        # None stores the entries next to the raw output of every simulation
+        self.cache_dir = cache_dir
+
+    def key(self, path: str, name: str, loggers):
+        key = hashlib.sha1()
+        key.update(os.path.abspath(path).encode())
+        key.update(name.encode())
+        for field in self.config_fields:
+            key.update(repr(getattr(self.config, field, None)).encode())
+        for logger in loggers:
+            stat = os.stat(os.path.join(path, logger))
+            key.update(
+                "{}:{}:{}".format(logger, stat.st_mtime_ns, stat.st_size).encode()
+            )
+        return key.hexdigest()
+
+    def file(self, path: str, name: str, key: str):
+        if self.cache_dir is None:
+            return os.path.join(path, ".parse_cache", name + "-" + key + ".npy")
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def load(self, file: str):
+        try:
+            return np.load(file, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, file: str, value):
+        """Writes an entry. A failed write (e.g. a read-only output folder) only
+        costs the entry, it is logged and the value is parsed again next time."""
+        # parallel readers and the threads of batched runs may race on an entry
+        try:
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with atomic_write(file) as f:
+                np.save(f, value, allow_pickle=False)
+        except OSError as error:
+            print("Parse cache entry not written: {}".format(error))
+
+
+def cached(*loggers):
+    """Caches the numpy result of a DataReader method taking a simulation directory
+    (a logger file inside it or its LoggerContext) in the reader's parse cache.
+    Calls requesting pandas output (to_np=False) and contexts which are not
+    cacheable bypass the cache.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def new_func(self, path, *args, **kwargs):
+            cache = self.parse_cache
+            to_np = kwargs.get("to_np", args[0] if len(args) > 0 else True)
+            if cache is None or not to_np or not getattr(path, "cacheable", True):
+                return func(self, path, *args, **kwargs)
+
+            # path may be a directory, a logger file in it or a LoggerContext
+            directory = getattr(path, "path", path)
+            if not os.path.isdir(directory):
+                directory = os.path.dirname(directory)
+            file = cache.file(
+                directory, func.__name__, cache.key(directory, func.__name__, loggers)
+            )
+            result = cache.load(file)
+            if result is None:
+                result = np.asarray(func(self, path, *args, **kwargs))
+                cache.store(file, result)
+            return result
+
+        return new_func
+
+    return decorator
@@ -0,0 +1,181 @@
+import hashlib
+import os
+import numpy as np
+import tensorflow as tf
+from OfflineStore import OfflineStore
+from Utility import atomic_write
+
+
+class RecordStore(OfflineStore):
+    """Offline dataset as sharded TFRecord files with a json header."""
+
+    # bumped whenever the layout of the records changes
+    format_version = 2
+    validation_file = "validation.npz"
+    shard_pattern = "shard-{:05d}.tfrecord"
+    config_fields = OfflineStore.config_fields + [
+        "validation_source",
+        "validation_seed",
+    ]
+
+    def __init__(self, config, path: str):
+        OfflineStore.__init__(self, config, path)
+        self.shards = []
+
+    def config_hash(self):
+        # of resimulation_param only the number of held-out simulations matters
+        config_hash = hashlib.sha1(OfflineStore.config_hash(self).encode())
+        resimulation_param = getattr(self.config, "resimulation_param", None) or {}
+        config_hash.update(repr(resimulation_param.get("simulations")).encode())
+        return config_hash.hexdigest()
+
+    def create(self, shape, dtype):
+        """Starts a new set of shards for simulations of the given shape and dtype."""
+        os.makedirs(self.path, exist_ok=True)
+        self.remove_meta()
+        validation_path = os.path.join(self.path, self.validation_file)
+        if os.path.exists(validation_path):
+            os.remove(validation_path)
+        self.shards = []
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+    def channels(self):
+        return self.dtype.names or ("sim",)
+
+    def write_shard(self, dfs, params):
+        """Writes the simulations dfs with their parameters params as the next shard."""
+        file = self.shard_pattern.format(len(self.shards))
+        with tf.io.TFRecordWriter(os.path.join(self.path, file)) as writer:
+            for sim, param in zip(dfs, params):
+                feature = {
+                    "params": tf.train.Feature(
+                        float_list=tf.train.FloatList(value=param)
+                    )
+                }
+                for channel in self.channels():
+                    values = sim if channel == "sim" else sim[channel]
+                    feature[channel] = tf.train.Feature(
+                        bytes_list=tf.train.BytesList(
+                            value=[np.ascontiguousarray(values).tobytes()]
+                        )
+                    )
+                writer.write(
+                    tf.train.Example(
+                        features=tf.train.Features(feature=feature)
+                    ).SerializeToString()
+                )
+        self.shards.append({"file": file, "size": len(dfs)})
+
+    def write_validation(self, dfs, params):
+        """Keeps the held-out simulations dfs with their parameters params apart from
+        the shards, see DataReader.holdout."""
+        with atomic_write(os.path.join(self.path, self.validation_file)) as f:
+            np.savez(f, sim_data=dfs, prior_draws=params)
+
+    def validation(self):
+        """Held-out forward dict {"prior_draws", "sim_data"}, None if there is none."""
+        validation_path = os.path.join(self.path, self.validation_file)
+        if not os.path.exists(validation_path):
+            return None
+        with np.load(validation_path, allow_pickle=False) as validation:
+            return {
+                "prior_draws": validation["prior_draws"],
+                "sim_data": validation["sim_data"],
+            }
+
+    def finalize(self, dropped):
+        self.write_meta(
+            {
+                "shape": list(self.shape),
+                "dtype": np.lib.format.dtype_to_descr(self.dtype),
+                "prior_names": list(self.config.prior_names),
+                "shards": self.shards,
+                "dropped": dict(dropped),
+            }
+        )
+
+    def open(self):
+        """Reads the header, returns the number of simulations."""
+        meta = self.read_meta()
+        self.shards = meta["shards"]
+        self.shape = tuple(meta["shape"])
+        self.dtype = np.lib.format.descr_to_dtype(
+            [tuple(x) for x in meta["dtype"]]
+            if isinstance(meta["dtype"], list)
+            else meta["dtype"]
+        )
+        return sum(shard["size"] for shard in self.shards)
+
+    def dataset(self, batch_size, shuffle_buffer=4096, seed=None, configure=None):
+        """Endless tf.data pipeline of shuffled batches {"prior_draws", "sim_data"}.
+        Shards are read interleaved, records are decoded batch-wise in parallel and
+        the next batches are prefetched while the network trains. The channels are
+        stacked to float32 along a last axis, like prepare_input does. configure
+        (e.g. GraphConfigurator.map) is fused into the decoding.
+        """
+        files = [os.path.join(self.path, shard["file"]) for shard in self.shards]
+        features = {"params": tf.io.FixedLenFeature([self.config.param_nr], tf.float32)}
+        for channel in self.channels():
+            features[channel] = tf.io.FixedLenFeature([], tf.string)
+        dtypes = {
+            channel: tf.as_dtype(
+                self.dtype if channel == "sim" else self.dtype[channel]
+            )
+            for channel in self.channels()
+        }
+        shape = list(self.shape)
+
+        def decode(records):
+            example = tf.io.parse_example(records, features)
+            channels = [
+                tf.cast(
+                    tf.reshape(
+                        tf.io.decode_raw(example[channel], dtypes[channel]),
+                        [-1] + shape,
+                    ),
+                    tf.float32,
+                )
+                for channel in self.channels()
+            ]
+            sim_data = (
+                channels[0] if self.dtype.names is None else tf.stack(channels, -1)
+            )
+            batch = {"prior_draws": example["params"], "sim_data": sim_data}
+            return batch if configure is None else configure(batch)
+
+        return (
+            tf.data.Dataset.from_tensor_slices(files)
+            .shuffle(len(files), seed=seed, reshuffle_each_iteration=True)
+            .repeat()
+            .interleave(
+                tf.data.TFRecordDataset,
+                cycle_length=min(len(files), 4),
+                num_parallel_calls=tf.data.AUTOTUNE,
+                deterministic=False,
+            )
+            .shuffle(shuffle_buffer, seed=seed)
+            .batch(batch_size, drop_remainder=True)
+            .map(decode, num_parallel_calls=tf.data.AUTOTUNE)
+            .prefetch(tf.data.AUTOTUNE)
+        )
+
+
+class RecordSampler:
+    """Batches of the tf.data pipeline of a RecordStore."""
+
+    def __init__(
+        self, records: RecordStore, batch_size, shuffle_buffer=4096, configure=None
+    ):
+        self.batch_size = batch_size
+        dataset = records.dataset(batch_size, shuffle_buffer, configure=configure)
+        self.batches = (
+            dataset.as_numpy_iterator() if configure is None else iter(dataset)
+        )
+
+    def __call__(self, batch_size, **kwargs):
+        if batch_size != self.batch_size:
+            raise ValueError(
+                "records are batched by {}, not {}".format(self.batch_size, batch_size)
+            )
+        return next(self.batches)
@@ -4,9 +4,13 @@ import numpy as np
 from SimulationRunnerInterface import SimulationRunnerInterface
 import pandas as pd
 import plotnine as p9
+from Metrics import metrics
 
 
 class ResultLogger:
+    # quantile bands (lower, upper, alpha) drawn around the mean resimulation
+    ribbons = [(0.25, 0.75, 0.2), (0.05, 0.95, 0.3), (0.025, 0.975, 0.4)]
+
     def __init__(
         self,
         workdir,
@@ -18,6 +22,8 @@ class ResultLogger:
         model,
         configurator,
         amortizer,
+        simulationRunner=None,
+        validation_sims=None,
     ):
         self.workdir = workdir
         self.trainer = trainer
@@ -28,6 +34,9 @@ class ResultLogger:
         self.model = model
         self.configurator = configurator
         self.amortizer = amortizer
+        self.simulationRunner = simulationRunner
+        # raw forward dict held out of the offline training data, None simulates
+        self.validation_sims = validation_sims
 
         self.output_dir = os.path.abspath(os.path.join(workdir, config.plots))
 
@@ -36,18 +45,14 @@ class ResultLogger:
 
         self.prior_means, self.prior_stds = prior.estimate_means_and_stds()
 
-    def __percentile__(self, n):
-        def percentile(x):
-            return np.percentile(x, n)
-
-        percentile.__name__ = "percentile_%s" % n
-        return percentile
-
     def __get_resimulation_data__(self):
         res = {}
-        res["raw_sims"] = self.model(
-            batch_size=self.config.resimulation_param["simulations"]
-        )
+        if self.validation_sims is not None:
+            res["raw_sims"] = self.validation_sims
+        else:
+            res["raw_sims"] = self.model(
+                batch_size=self.config.resimulation_param["simulations"]
+            )
         res["validation_sims"] = self.configurator(res["raw_sims"])
         res["post_samples"] = self.amortizer.sample(
             res["validation_sims"], self.config.resimulation_param["post_samples"]
@@ -61,118 +66,130 @@ class ResultLogger:
         plot_dir = os.path.abspath(os.path.join(self.workdir, self.config.plots))
 
         if self.config.losses:
-            loss = self.diag.plot_losses(self.losses)
-            loss.savefig(os.path.join(plot_dir, "losses.png"))
-            plt.close(loss)
+            with metrics.time("diagnostics.losses"):
+                loss = self.diag.plot_losses(self.losses)
+                loss.savefig(os.path.join(plot_dir, "losses.png"))
+                plt.close(loss)
 
         if self.config.latent2d:
-            latent2d = self.trainer.diagnose_latent2d()
-            latent2d.savefig(os.path.join(plot_dir, "latent2d.png"))
-            plt.close(latent2d)
+            with metrics.time("diagnostics.latent2d"):
+                latent2d = self.trainer.diagnose_latent2d()
+                latent2d.savefig(os.path.join(plot_dir, "latent2d.png"))
+                plt.close(latent2d)
 
         if self.config.sbc_histograms:
-            sbc_histograms = self.trainer.diagnose_sbc_histograms()
-            sbc_histograms.savefig(os.path.join(plot_dir, "sbc_histograms.png"))
-            plt.close(sbc_histograms)
+            with metrics.time("diagnostics.sbc_histograms"):
+                sbc_histograms = self.trainer.diagnose_sbc_histograms()
+                sbc_histograms.savefig(os.path.join(plot_dir, "sbc_histograms.png"))
+                plt.close(sbc_histograms)
 
         if self.config.run_resimualtions:
-            res = self.__get_resimulation_data__()
+            with metrics.time("diagnostics.resimulation_data"):
+                res = self.__get_resimulation_data__()
 
         if self.config.sbc_ecdf:
-            sbc_ecdf = self.diag.plot_sbc_ecdf(
-                res["post_samples"], res["validation_sims"]["parameters"]
-            )
-            sbc_ecdf.savefig(os.path.join(plot_dir, "sbc_ecdf.png"))
-            plt.close(sbc_ecdf)
+            with metrics.time("diagnostics.sbc_ecdf"):
+                sbc_ecdf = self.diag.plot_sbc_ecdf(
+                    res["post_samples"], res["validation_sims"]["parameters"]
+                )
+                sbc_ecdf.savefig(os.path.join(plot_dir, "sbc_ecdf.png"))
+                plt.close(sbc_ecdf)
 
         # TODO: posterior scores, correlation
 
         if self.config.recovery:
-            recovery = self.diag.plot_recovery(
-                res["post_samples"],
-                res["validation_sims"]["parameters"],
-                param_names=self.config.prior_names,
-            )
-            recovery.savefig(os.path.join(plot_dir, "recovery.png"))
-            plt.close(recovery)
+            with metrics.time("diagnostics.recovery"):
+                recovery = self.diag.plot_recovery(
+                    res["post_samples"],
+                    res["validation_sims"]["parameters"],
+                    param_names=self.config.prior_names,
+                )
+                recovery.savefig(os.path.join(plot_dir, "recovery.png"))
+                plt.close(recovery)
 
         # if self.config.post_eval:
         #     fig, plot = self.plot_posterior_eval(res)
         #     fig.savefig(os.path.join(plot_dir, "post_eval.png"))
 
         # if self.config.resimulation:
-        #     for rep in range(self.config.nr_resimulations):
+        #     resims = self.resimulate(
+        #         self.simulationRunner,
+        #         res["post_samples_unnorm"][: self.config.nr_resimulations],
+        #     )
+        #     for rep in range(len(resims)):
         #         fig, plot = self.create_resimulation_plot(
-        #             simulationRunner, res["post_samples"][rep], res["raw_sims"][""]
+        #             resims[rep], res["raw_sims"]["sim_data"][rep], rep
         #         )
 
-    def create_resimulation_plot(self, simulation, posterior, ground_truth, id):
+    def resimulate(self, simulation, posteriors, nr_draws=10, seed=0):
+        """Resimulates nr_draws draws of the (datasets, samples, n_params) posterior
+        samples of every dataset. All simulations are submitted together to the
+        simulation pool (resimulation_workers Morpheus processes), so the wall time
+        is bounded by the pool size rather than the number of simulations. Returns
+        a preallocated (datasets, nr_draws, timesteps, observables) array.
+        """
         simulationRunner: SimulationRunnerInterface = simulation
-
-        cut_ts = (
-            self.config.timesteps
-            - self.config.cut_off_end
-            - self.config.cut_off_start
-            - 1
-        )
-        time_range = range(0, cut_ts)
-        nr_resimulations = 10
-
-        resim = np.zeros(
-            ((nr_resimulations * cut_ts, len(self.config.observables) + 1))
-        )
-        for i in range(nr_resimulations):
-            resim[i * cut_ts : (i + 1) * cut_ts, :] = np.append(
-                np.asarray(simulationRunner.run(posterior)),
-                np.expand_dims(range(0, cut_ts), axis=1),
-            )
-        df = pd.DataFrame(resim, columns=self.config.observables.append("time"))
-        agg = df.groupby(["time"]).agg(
+        posteriors = np.asarray(posteriors)
+        rng = np.random.default_rng(seed)
+        draws = np.stack(
             [
-                "mean",
-                "std",
-                self.__percentile__(0.25),
-                self.__percentile__(0.75),
-                self.__percentile__(0.05),
-                self.__percentile__(0.95),
-                self.__percentile__(0.025),
-                self.__percentile__(0.975),
+                posterior[
+                    rng.choice(len(posterior), nr_draws, len(posterior) < nr_draws)
+                ]
+                for posterior in posteriors
             ]
         )
-        gt_index = pd.MultiIndex.from_arrays(
-            [self.config.observables, np.repeat("gt", len(self.config.observables))]
+        resim = np.empty(
+            (*draws.shape[:2], *simulationRunner.dataReader.sim_shape(spatial=False))
         )
-        gt = pd.DataFrame(ground_truth)
-        agg[gt_index] = gt
-        agg = agg.sort_index(axis=1)
-        agg = (
-            pd.melt(agg.reset_index(), id_vars=["t"])
-            .pivot(index=["t", "variable_0"], columns="variable_1")["value"]
-            .reset_index()
+        simulationRunner.run_batch(
+            draws.reshape(-1, draws.shape[-1]),
+            getattr(self.config, "resimulation_workers", None) or os.cpu_count(),
+            out=resim.reshape(-1, *resim.shape[2:]),
         )
-
-        fig, plot = (
-            p9.ggplot(agg, p9.aes(x="t"))
-            + p9.geom_ribbon(
-                p9.aes(ymin="percentile_0.25", ymax="percentile_0.75"),
-                fill="blue",
-                alpha=0.2,
-            )
-            + p9.geom_ribbon(
-                p9.aes(ymin="percentile_0.05", ymax="percentile_0.95"),
-                fill="blue",
-                alpha=0.3,
-            )
-            + p9.geom_ribbon(
-                p9.aes(ymin="percentile_0.025", ymax="percentile_0.975"),
+        return resim
+
+    def aggregate_resimulations(self, resim, ground_truth):
+        """Plotting frame of the (nr_draws, timesteps, observables) resimulations of
+        one dataset: one row per timestep t and observable variable_0 with the mean,
+        the std, the ground truth gt and a percentile_<q> column per quantile of the
+        ribbons. All quantiles are computed in one pass along the draws.
+        """
+        resim = np.asarray(resim, dtype=float)
+        nr_resimulations, cut_ts, nr_observables = resim.shape
+        quantiles = sorted({q for ribbon in self.ribbons for q in ribbon[:2]})
+        columns = {
+            "t": np.repeat(np.arange(cut_ts), nr_observables),
+            "variable_0": np.tile(list(self.config.observables), cut_ts),
+            "mean": resim.mean(axis=0).ravel(),
+            "std": resim.std(axis=0, ddof=1).ravel(),
+            "gt": np.asarray(ground_truth, dtype=float).ravel(),
+        }
+        for q, band in zip(quantiles, np.quantile(resim, quantiles, axis=0)):
+            columns["percentile_{}".format(q)] = band.ravel()
+        return pd.DataFrame(columns)
+
+    def create_resimulation_plot(self, resim, ground_truth, id):
+        """Ribbons of the (nr_draws, timesteps, observables) resimulations of one
+        dataset, see resimulate, around its ground truth."""
+        agg = self.aggregate_resimulations(resim, ground_truth)
+
+        plot = p9.ggplot(agg, p9.aes(x="t"))
+        for lower, upper, alpha in self.ribbons:
+            plot += p9.geom_ribbon(
+                p9.aes(
+                    ymin="percentile_{}".format(lower),
+                    ymax="percentile_{}".format(upper),
+                ),
                 fill="blue",
-                alpha=0.4,
+                alpha=alpha,
             )
-            + p9.geom_line(p9.aes(y="mean"), color="black")
+        plot += (
+            p9.geom_line(p9.aes(y="mean"), color="black")
             + p9.geom_point(p9.aes(y="mean"))
             + p9.facet_grid("variable_0 ~ .")
         )
-        return fig, plot
+        return plot.draw(), plot
 
     def plot_posterior_eval(self, resimulation_data):
         df_prior = pd.DataFrame(
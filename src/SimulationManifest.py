@@ -0,0 +1,165 @@
+import fnmatch
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+from Utility import atomic_path, logger_stat
+
+
+class SimulationManifest:
+    """Index of the simulation directories of one output folder, kept as a csv file
+    in the .manifest subdirectory of the folder. Every row holds the directory name, the values parsed from the
+    name, the parameters and validity found by the reader's check, the number of
+    logged timesteps and the size and modification time of the loggers. update()
+    only checks directories which are new or whose loggers changed, so the offline
+    readers get their file list and parameters without globbing and parsing names.
+    The modification time of the csv file is set to the one the folder had before
+    it was scanned; as long as they agree no directory was added or removed and the
+    index is used without touching the simulation directories, see current().
+    """
+
+    columns = ["name", "valid", "reason", "timesteps", "size", "mtime_ns"]
+    # the check results depend on these fields
+    config_fields = [
+        "prior_names",
+        "param_nr",
+        "timesteps",
+        "cut_off_start",
+        "cut_off_end",
+    ]
+
+    def __init__(self, config, folder: str, spatial: bool, check, loggers):
+        self.config = config
+        self.folder = folder
+        self.spatial = spatial
+        self.check = check
+        self.loggers = loggers
+        self.changes = {"added": [], "changed": [], "removed": []}
+
+    def file(self):
+        key = hashlib.sha1(repr(self.spatial).encode())
+        for field in self.config_fields:
+            key.update(repr(getattr(self.config, field, None)).encode())
+        # writing the csv into a subdirectory leaves the folder's mtime unchanged
+        return os.path.join(
+            self.folder, ".manifest", "{}.csv".format(key.hexdigest()[:12])
+        )
+
+    def load(self):
+        """The index as last written, without touching the simulation directories."""
+        if not os.path.exists(self.file()):
+            return pd.DataFrame(columns=self.columns).astype({"valid": bool})
+        index = pd.read_csv(
+            self.file(), keep_default_na=False, na_values=[""], dtype={"valid": bool}
+        )
+        return index.fillna({"reason": ""})
+
+    @staticmethod
+    def name_values(name: str):
+        """key-value pairs of a directory name such as DV-0.1_bcf-1e-05_cV-0.5."""
+        values = {}
+        for token in name.split("_"):
+            key, _, value = token.partition("-")
+            try:
+                values["name." + key] = float(value)
+            except ValueError:
+                continue
+        return values
+
+    @staticmethod
+    def count_timesteps(pathname: str):
+        try:
+            with open(os.path.join(pathname, "logger_2.csv")) as f:
+                return sum(1 for _ in f) - 1
+        except OSError:
+            return -1
+
+    def entry(self, pathname: str, size: int, mtime_ns: int):
+        params, reason = self.check(pathname)
+        row = {
+            "name": os.path.basename(pathname),
+            "valid": reason is None,
+            "reason": reason or "",
+            "timesteps": self.count_timesteps(pathname),
+            "size": size,
+            "mtime_ns": mtime_ns,
+        }
+        row.update(self.name_values(row["name"]))
+        if params is not None:
+            row.update({"params.{}".format(i): value for i, value in enumerate(params)})
+        return row
+
+    def is_fresh(self):
+        """True if no directory was added to or removed from the folder since the
+        last update(). Changed loggers of existing directories are only found by
+        update()."""
+        try:
+            return os.stat(self.file()).st_mtime_ns == os.stat(self.folder).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def current(self, refresh: bool = False):
+        """The index as written if it is fresh, otherwise (or with refresh) updated."""
+        if not refresh and self.is_fresh():
+            self.changes = {"added": [], "changed": [], "removed": []}
+            return self.load()
+        return self.update()
+
+    def update(self):
+        """Brings the index up to date with the folder and writes it if anything
+        changed. The names of added, changed and removed directories are kept in
+        changes."""
+        index = self.load()
+        known = {row["name"]: row for row in index.to_dict("records")}
+        self.changes = {"added": [], "changed": [], "removed": []}
+        os.makedirs(os.path.dirname(self.file()), exist_ok=True)
+        # directories added while scanning make the index stale again
+        folder_mtime_ns = os.stat(self.folder).st_mtime_ns
+
+        rows = []
+        with os.scandir(self.folder) as entries:
+            directories = sorted(
+                x.name for x in entries if x.is_dir() and not x.name.startswith(".")
+            )
+        for name in directories:
+            pathname = os.path.join(self.folder, name)
+            size, mtime_ns = logger_stat(pathname, self.loggers)
+            row = known.pop(name, None)
+            if row is not None and row["size"] == size and row["mtime_ns"] == mtime_ns:
+                rows.append(row)
+                continue
+            self.changes["changed" if row is not None else "added"].append(name)
+            rows.append(self.entry(pathname, size, mtime_ns))
+        self.changes["removed"] = sorted(known)
+
+        if any(len(x) > 0 for x in self.changes.values()) or not os.path.exists(
+            self.file()
+        ):
+            index = pd.DataFrame(rows, columns=self.__columns__(rows))
+            with atomic_path(self.file()) as tmp_file:
+                index.to_csv(tmp_file, index=False)
+        os.utime(self.file(), ns=(os.stat(self.file()).st_atime_ns, folder_mtime_ns))
+        return self.load()
+
+    def __columns__(self, rows):
+        columns = list(self.columns)
+        for row in rows:
+            columns += [x for x in row if x not in columns]
+        return columns
+
+    def select(self, index, pattern: str = "*", ranges: dict = None):
+        """Rows of the index whose name matches pattern and whose name values lie in
+        the closed intervals ranges, e.g. {"DV": (0.0, 0.5)}."""
+        keep = np.array([fnmatch.fnmatch(x, pattern) for x in index["name"]], bool)
+        for key, (low, high) in (ranges or {}).items():
+            values = index.get("name." + key)
+            if values is None:
+                keep[:] = False
+                continue
+            keep &= (values >= low).to_numpy() & (values <= high).to_numpy()
+        return index[keep]
+
+    def params(self, index):
+        """(rows, param_nr) float32 parameters of the rows of index."""
+        columns = ["params.{}".format(i) for i in range(self.config.param_nr)]
+        return index.reindex(columns=columns).to_numpy(dtype=np.float32)
@@ -0,0 +1,70 @@
+import queue
+import threading
+from Metrics import metrics
+
+
+class SimulationPrefetcher:
+    """Simulates and configures batches in background threads during training."""
+
+    def __init__(self, model, configurator, batch_size, depth=2, workers=1):
+        self.model = model
+        self.configure = configurator
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.stop_event = threading.Event()
+        self.threads = [
+            threading.Thread(target=self.__work__, daemon=True)
+            for _ in range(max(1, workers))
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def __work__(self):
+        while not self.stop_event.is_set():
+            try:
+                batch = self.configure(self.model(self.batch_size))
+            except Exception as error:
+                batch = error
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(batch, Exception):
+                return
+
+    def __call__(self, batch_size, **kwargs):
+        if batch_size != self.batch_size or self.stop_event.is_set():
+            return self.model(batch_size, **kwargs)
+        # ready batches and the time the trainer waits for the simulations
+        metrics.observe("prefetch.queue_depth", self.queue.qsize())
+        with metrics.time("prefetch.wait"):
+            batch = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def configurator(self, forward_dict, **kwargs):
+        """Configurator for the trainer: batches configured in the background pass
+        through, raw forward dicts are configured as usual."""
+        if "sim_data" not in forward_dict:
+            return forward_dict
+        return self.configure(forward_dict, **kwargs)
+
+    def close(self):
+        """Stops the workers once their current batch is done and drops the queue."""
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
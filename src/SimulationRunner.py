@@ -1,195 +1,292 @@
 import glob
-import os, sys
-from subprocess import Popen, PIPE, STDOUT
+import os
+import shutil
+import tempfile
+from subprocess import Popen, TimeoutExpired
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import time
-from pandas import read_csv
-from Utility import timeit
-from contextlib import redirect_stdout, redirect_stderr
+from Utility import atomic_write, timeit
+from Metrics import metrics
 from SimulationRunnerInterface import SimulationRunnerInterface
+from LoggerContext import LoggerContext
+from SimulationStore import SimulationStore
+from ModelRewriter import ModelRewriter
+
+
+class SimulationError(RuntimeError):
+    def __init__(self, command, reason):
+        RuntimeError.__init__(self, "{}: {}".format(" ".join(command), reason))
+        self.command = command
+        self.reason = reason
 
 
 class SimulationRunner(SimulationRunnerInterface):
+    # hash of the model a finished output directory was simulated with
+    model_hash_file = ".model_hash"
+
     def __init__(self, config, workdir, dataReader):
         SimulationRunnerInterface.__init__(self)
         self.config = config
         self.workdir = workdir
         self.dataReader = dataReader
+        self.simulationStore = None
+        if getattr(config, "simulation_store", False):
+            self.simulationStore = SimulationStore(
+                config,
+                getattr(config, "simulation_store_dir", None)
+                or os.path.join(config.data_path, config.folder, ".simulation_store"),
+            )
+        self.modelRewriter = None
+        if getattr(config, "rewrite_model", False):
+            self.modelRewriter = ModelRewriter(
+                os.path.join(config.data_path, "model", ".derived")
+            )
 
-    @timeit
-    def run(self, params):
-        with open(os.path.join(self.workdir, "log_morpheus.txt"), "w") as logfile:
-            with redirect_stderr(logfile), redirect_stdout(logfile):
-                model_dir = "model"
-                model_pattern = os.path.join(
-                    self.config.data_path,
-                    model_dir,
-                    self.config.model_pattern,
-                )
-                models = glob.glob(model_pattern)
-                model = models[0]
+    def __model__(self):
+        model_dir = "model"
+        model_pattern = os.path.join(
+            self.config.data_path,
+            model_dir,
+            self.config.model_pattern,
+        )
+        models = glob.glob(model_pattern)
+        return models[0]
 
-                priors = dict(zip(self.config.prior_names, params))
-                path_param_str = "_".join(
-                    "-".join((key, str(value))) for key, value in priors.items()
-                )
-                morpheus_param_str = " ".join(
-                    "=".join(("-" + key, str(value))) for key, value in priors.items()
-                )
+    def __output_dir__(self, params):
+        priors = dict(zip(self.config.prior_names, params))
+        path_param_str = "_".join(
+            "-".join((key, str(value))) for key, value in priors.items()
+        )
 
-                if len(self.config.fixed_params) > 0:
-                    path_param_str += "_" + "_".join(
-                        "-".join((key, str(value)))
-                        for key, value in self.config.fixed_params.items()
-                    )
-                    morpheus_param_str += " " + " ".join(
-                        "=".join(("-" + key, str(value)))
-                        for key, value in self.config.fixed_params.items()
-                    )
-
-                OUT = os.path.join(
-                    self.config.data_path, self.config.folder, path_param_str
-                )
-                create_dir = Popen(
-                    "mkdir " + OUT, shell=True, stdout=sys.stdout, stderr=sys.stderr
-                )
-                create_dir.wait()
-                morpheus_command = (
-                    "morpheus"
-                    + " -f "
-                    + model
-                    + " -o "
-                    + OUT
-                    + " "
-                    + morpheus_param_str
-                )
-                print(morpheus_command)
+        if len(self.config.fixed_params) > 0:
+            path_param_str += "_" + "_".join(
+                "-".join((key, str(value)))
+                for key, value in self.config.fixed_params.items()
+            )
+        return os.path.join(self.config.data_path, self.config.folder, path_param_str)
 
-                run_sim = Popen(
-                    morpheus_command, shell=True, stdout=sys.stdout, stderr=sys.stderr
-                )
-                run_sim.wait()
+    def __scratch_dir__(self):
+        scratch_dir = getattr(self.config, "scratch_dir", None)
+        if scratch_dir == "auto":
+            # tmpfs keeps the raw loggers off the disk
+            if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+                return "/dev/shm"
+            return tempfile.gettempdir()
+        return scratch_dir
 
-                final_plot = os.path.join(
-                    OUT, "plot_" + str(self.config.timesteps).zfill(5) + ".png"
-                )
-                while not os.path.exists(final_plot):
-                    time.sleep(1)
-
-                population_file = os.path.join(OUT, "logger_2.csv")
-                df = read_csv(population_file, sep="\t")
-                df_tar = df["celltype.target.size"].values[:, np.newaxis][
-                    self.config.cut_off_start
-                    + 1 : self.config.timesteps
-                    - self.config.cut_off_end
-                ]
-                df_inf = df["celltype.infected.size"].values[:, np.newaxis][
-                    self.config.cut_off_start
-                    + 1 : self.config.timesteps
-                    - self.config.cut_off_end
-                ]
-                df_cells = np.append(df_tar, df_inf, axis=1)
-
-                v_path = os.path.join(OUT, "logger_6_Ve.csv")
-                v = self.dataReader.calculate_V(v_path)
-                sim = np.append(df_cells, v, axis=1)
-                I_volume = self.dataReader.calculate_volume(OUT)[
-                    self.config.cut_off_start
-                    + 1 : self.config.timesteps
-                    - self.config.cut_off_end
-                ]
-                sim = np.append(sim, I_volume, axis=1)
-
-                return sim
+    def __archive__(self, params, spatial):
+        """Compressed archive of a scratch run, kept in .archive of the output folder
+        so the offline readers globbing the folder do not pick it up."""
+        output_dir = self.__output_dir__(params)
+        return os.path.join(
+            os.path.dirname(output_dir),
+            ".archive",
+            os.path.basename(output_dir) + ("_2d.npz" if spatial else ".npz"),
+        )
+
+    def __load_archive__(self, archive, key, spatial):
+        """Archived simulation, None if it is missing, unreadable or was archived for
+        another store key, shape or dtype."""
+        try:
+            with np.load(archive, allow_pickle=False) as archived:
+                if "key" not in archived or str(archived["key"]) != key:
+                    return None
+                sim = archived["sim"]
+        except (OSError, ValueError, KeyError):
+            return None
+        dtype = self.dataReader.sim_dtype(spatial)
+        if sim.shape != self.dataReader.sim_shape(spatial) or (
+            sim.dtype != dtype if spatial else sim.dtype.kind != dtype.kind
+        ):
+            return None
+        return sim
+
+    def __has_model__(self, OUT, model_hash):
+        """True if OUT was simulated with the model of model_hash."""
+        try:
+            with open(os.path.join(OUT, self.model_hash_file)) as f:
+                return f.read() == model_hash
+        except OSError:
+            return False
+
+    def __simulate__(self, params, loggers, logfile, OUT=None):
+        """Runs Morpheus for one parameter vector and returns its output directory
+        once the process exited and the given loggers exist. Raises a SimulationError
+        on timeouts, failed runs and missing loggers. Morpheus writes to logfile
+        directly, redirecting sys.stdout is not safe from background threads.
+        """
+        model = self.__model__()
+        if self.modelRewriter is not None:
+            model = self.modelRewriter.derive(model, loggers)
+        priors = dict(zip(self.config.prior_names, params))
+        if OUT is None:
+            OUT = self.__output_dir__(params)
+        os.makedirs(OUT, exist_ok=True)
+        executable = getattr(self.config, "morpheus_executable", "morpheus")
+        morpheus_command = [executable, "-f", model, "-o", OUT] + [
+            "-{}={}".format(key, value)
+            for key, value in list(priors.items())
+            + list(self.config.fixed_params.items())
+        ]
+        print(" ".join(morpheus_command), file=logfile, flush=True)
+
+        metrics.count("simulation.runs")
+        with metrics.time("simulation.launch"):
+            run_sim = Popen(morpheus_command, stdout=logfile, stderr=logfile)
+        start_time = time.perf_counter()
+        try:
+            returncode = run_sim.wait(
+                timeout=getattr(self.config, "simulation_timeout", None)
+            )
+        except TimeoutExpired:
+            run_sim.kill()
+            run_sim.wait()
+            metrics.count("simulation.timeouts")
+            raise SimulationError(morpheus_command, "timed out")
+        if returncode != 0:
+            metrics.count("simulation.failures")
+            raise SimulationError(
+                morpheus_command, "exited with code {}".format(returncode)
+            )
+        metrics.record("simulation.morpheus", time.perf_counter() - start_time)
+
+        # the loggers are complete once Morpheus exited, slow file systems may
+        # take a moment to show them
+        start_time = time.perf_counter()
+        deadline = time.monotonic() + getattr(self.config, "completion_timeout", 10)
+        missing = [x for x in loggers if not os.path.exists(os.path.join(OUT, x))]
+        while len(missing) > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+            missing = [x for x in missing if not os.path.exists(os.path.join(OUT, x))]
+        if len(missing) > 0:
+            metrics.count("simulation.failures")
+            raise SimulationError(
+                morpheus_command, "did not write " + ", ".join(missing)
+            )
+        metrics.record("simulation.completion", time.perf_counter() - start_time)
+        return OUT
+
+    def __parse__(self, parse, OUT):
+        with metrics.time("simulation.parse"):
+            return parse(OUT)
+
+    def __execute__(self, params, spatial, parse, loggers, logfile, key=None):
+        """Simulates and parses params. With a scratch directory Morpheus writes into
+        a temporary directory there, which is removed after parsing; only the parsed
+        simulation is kept as a compressed archive with its store key, see
+        __archive__.
+        """
+        scratch_dir = self.__scratch_dir__()
+        if scratch_dir is None:
+            return self.__parse__(parse, self.__simulate__(params, loggers, logfile))
+
+        OUT = tempfile.mkdtemp(prefix="morpheus-", dir=scratch_dir)
+        try:
+            self.__simulate__(params, loggers, logfile, OUT)
+            # parse cache entries of a temporary directory could never be hit
+            sim = self.__parse__(
+                parse, LoggerContext(OUT, self.config, cacheable=False)
+            )
+        finally:
+            shutil.rmtree(OUT, ignore_errors=True)
+
+        archive = self.__archive__(params, spatial)
+        os.makedirs(os.path.dirname(archive), exist_ok=True)
+        with atomic_write(archive) as f:
+            np.savez_compressed(f, sim=sim, key=key or "")
+        return sim
+
+    def __run__(self, params, spatial, logfile):
+        """Parsed simulation for params. With a simulation store, stored results,
+        archives and finished runs of the same model and settings are reused
+        instead of launching Morpheus.
+        """
+        if spatial:
+            parse, loggers = self.dataReader.get_simulation_2d, LoggerContext.loggers_2d
+        else:
+            parse, loggers = self.dataReader.get_simulation, LoggerContext.loggers
+
+        store = self.simulationStore
+        if store is None:
+            return self.__execute__(params, spatial, parse, loggers, logfile)
+
+        model = self.__model__()
+        key = store.key(model, params, spatial)
+        sim = store.load(key)
+        if sim is not None:
+            return sim
+
+        OUT = self.__output_dir__(params)
+        archive = self.__archive__(params, spatial)
+        model_hash = store.model_hash(model)
+        if os.path.exists(archive):
+            sim = self.__load_archive__(archive, key, spatial)
+            if sim is not None:
+                store.count("reused")
+        elif self.__has_model__(OUT, model_hash) and all(
+            os.path.exists(os.path.join(OUT, x)) for x in loggers
+        ):
+            try:
+                sim = parse(OUT)
+                store.count("reused")
+            except Exception:
+                # incomplete output of an interrupted run
+                sim = None
+        if sim is None:
+            sim = self.__execute__(params, spatial, parse, loggers, logfile, key)
+            if self.__scratch_dir__() is None:
+                with atomic_write(os.path.join(OUT, self.model_hash_file), "w") as f:
+                    f.write(model_hash)
+            store.count("misses")
+        store.store(key, sim)
+        return sim
+
+    @timeit
+    def run(self, params):
+        with open(os.path.join(self.workdir, "log_morpheus.txt"), "w") as logfile:
+            sim = self.__run__(params, False, logfile)
+
+            return sim
 
     @timeit
     def run_2d(self, params):
         with open(os.path.join(self.workdir, "log_morpheus.txt"), "w") as logfile:
-            with redirect_stderr(logfile), redirect_stdout(logfile):
-                model_dir = "model"
-                model_pattern = os.path.join(
-                    self.config.data_path,
-                    model_dir,
-                    self.config.model_pattern,
-                )
-                models = glob.glob(model_pattern)
-                model = models[0]
+            sim = self.__run__(params, True, logfile)
 
-                priors = dict(zip(self.config.prior_names, params))
-                path_param_str = "_".join(
-                    "-".join((key, str(value))) for key, value in priors.items()
-                )
-                morpheus_param_str = " ".join(
-                    "=".join(("-" + key, str(value))) for key, value in priors.items()
-                )
+            return sim
 
-                if len(self.config.fixed_params) > 0:
-                    path_param_str += "_" + "_".join(
-                        "-".join((key, str(value)))
-                        for key, value in self.config.fixed_params.items()
-                    )
-                    morpheus_param_str += " " + " ".join(
-                        "=".join(("-" + key, str(value)))
-                        for key, value in self.config.fixed_params.items()
-                    )
-
-                OUT = os.path.join(
-                    self.config.data_path, self.config.folder, path_param_str
-                )
-                create_dir = Popen(
-                    "mkdir " + OUT, shell=True, stdout=sys.stdout, stderr=sys.stderr
-                )
-                create_dir.wait()
-                morpheus_command = (
-                    "morpheus"
-                    + " -f "
-                    + model
-                    + " -o "
-                    + OUT
-                    + " "
-                    + morpheus_param_str
-                )
-                print(morpheus_command)
+    def __run_batch__(self, params_batch, spatial, workers=None, out=None):
+        """Simulates and parses every row of params_batch with up to workers Morpheus
+        processes running at the same time. Each worker thread launches a simulation,
+        waits for it and parses its output, so parsing overlaps with the simulations
+        still running. Returns the stacked simulations in input order, written into
+        the preallocated array out if given.
+        """
+        if workers is None:
+            workers = getattr(self.config, "simulation_workers", 1)
+        if workers is None:
+            workers = os.cpu_count()
 
-                run_sim = Popen(
-                    morpheus_command, shell=True, stdout=sys.stdout, stderr=sys.stderr
+        with open(os.path.join(self.workdir, "log_morpheus.txt"), "w") as logfile:
+            with ThreadPoolExecutor(max(1, workers)) as pool:
+                sims = pool.map(
+                    lambda params: self.__run__(params, spatial, logfile),
+                    params_batch,
                 )
-                run_sim.wait()
+                if out is None:
+                    return np.stack(list(sims))
+                for index, sim in enumerate(sims):
+                    out[index] = sim
+                return out
 
-                final_plot = os.path.join(
-                    OUT, "plot_" + str(self.config.timesteps).zfill(5) + ".png"
-                )
-                while not os.path.exists(final_plot):
-                    time.sleep(1)
-
-                v = self.dataReader.calculate_V_2d(OUT).transpose((1, 2, 0))[
-                    :,
-                    :,
-                    self.config.cut_off_start
-                    + 1 : self.config.timesteps
-                    - self.config.cut_off_end,
-                ]
-                I = self.dataReader.get_cell_states_2d(OUT).transpose((1, 2, 0))[
-                    :,
-                    :,
-                    self.config.cut_off_start
-                    + 1 : self.config.timesteps
-                    - self.config.cut_off_end,
-                ]
-                id = self.dataReader.get_ids_2d(OUT).transpose((1, 2, 0))[
-                    :,
-                    :,
-                    self.config.cut_off_start
-                    + 1 : self.config.timesteps
-                    - self.config.cut_off_end,
-                ]
-                sim = np.concatenate(
-                    (
-                        np.expand_dims(v, axis=-1),
-                        np.expand_dims(id, axis=-1),
-                        np.expand_dims(I, axis=-1),
-                    ),
-                    axis=-1,
-                )
+    @timeit
+    def run_batch(self, params_batch, workers=None, out=None):
+        """Batched run for a (batch, n_params) prior draw, e.g. as BayesFlow
+        batch_simulator_fun."""
+        return self.__run_batch__(params_batch, False, workers, out)
 
-                return sim
+    @timeit
+    def run_2d_batch(self, params_batch, workers=None, out=None):
+        """Batched run_2d for a (batch, n_params) prior draw."""
+        return self.__run_batch__(params_batch, True, workers, out)
@@ -0,0 +1,74 @@
+import hashlib
+import os
+import threading
+import numpy as np
+from Metrics import metrics
+from Utility import atomic_write
+
+
+class SimulationStore:
+    """Parsed simulations indexed by the exact parameter vector, the fixed params,
+    the model file and the parse settings, so repeated parameter vectors never
+    launch Morpheus again. Entries are .npy files; the counters record store hits,
+    runs reused from existing output directories and misses which were simulated.
+    """
+
+    # bumped whenever the layout of the parsed simulations changes
+    format_version = 2
+    config_fields = [
+        "prior_names",
+        "fixed_params",
+        "viral_load_dtype",
+        "grid_size",
+        "timesteps",
+        "cut_off_start",
+        "cut_off_end",
+    ]
+
+    def __init__(self, config, path: str):
+        self.config = config
+        self.path = path
+        self.counters = {"hits": 0, "reused": 0, "misses": 0}
+        self.lock = threading.Lock()
+        self.model_hashes = {}
+
+    def model_hash(self, model: str):
+        stat = os.stat(model)
+        model_key = (model, stat.st_mtime_ns, stat.st_size)
+        if model_key not in self.model_hashes:
+            with open(model, "rb") as f:
+                self.model_hashes[model_key] = hashlib.sha1(f.read()).hexdigest()
+        return self.model_hashes[model_key]
+
+    def key(self, model: str, params, spatial: bool):
+        key = hashlib.sha1()
+        key.update(repr(self.format_version).encode())
+        key.update(self.model_hash(model).encode())
+        key.update(repr(bool(spatial)).encode())
+        for field in self.config_fields:
+            key.update(repr(getattr(self.config, field, None)).encode())
+        # repr keeps the exact value of every parameter
+        key.update(repr([float(x) for x in params]).encode())
+        return key.hexdigest()
+
+    def file(self, key: str):
+        return os.path.join(self.path, key[:2], key + ".npy")
+
+    def count(self, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
+        metrics.count("simulation_store." + counter)
+
+    def load(self, key: str):
+        try:
+            sim = np.load(self.file(key), allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+        self.count("hits")
+        return sim
+
+    def store(self, key: str, sim):
+        file = self.file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with atomic_write(file) as f:
+            np.save(f, np.asarray(sim), allow_pickle=False)
@@ -0,0 +1,132 @@
+import argparse
+import os
+import numpy as np
+
+
+def cell_grid(grid_size, cell_nr, rng):
+    """(grid, grid) cell ids of a Voronoi tessellation around cell_nr - 1 random
+    cell centers, the cells are numbered from 1 like Morpheus does."""
+    centers = rng.random((cell_nr - 1, 2)) * grid_size
+    y, x = np.mgrid[0:grid_size, 0:grid_size] + 0.5
+    ids = np.empty((grid_size, grid_size), dtype=np.int64)
+    # rows one by one keep the distance matrix small at the production scale
+    for row in range(grid_size):
+        distance = (y[row, :, np.newaxis] - centers[:, 0]) ** 2 + (
+            x[row, :, np.newaxis] - centers[:, 1]
+        ) ** 2
+        ids[row] = np.argmin(distance, axis=1) + 1
+    return ids, centers
+
+
+def simulate(grid_size, cell_nr, timesteps, seed=0):
+    """Synthetic infection of one simulation: cell ids per timestep, the infection
+    time of every cell and the extracellular virus field per timestep. The
+    infection spreads from one cell, the virus is produced by infected cells and
+    diffuses, the cell boundaries fluctuate a little over time.
+    """
+    rng = np.random.default_rng(seed)
+    ids, centers = cell_grid(grid_size, cell_nr, rng)
+    first = rng.integers(len(centers))
+    distance = np.linalg.norm(centers - centers[first], axis=1)
+    speed = rng.uniform(0.2, 1.0) * grid_size / max(timesteps, 1)
+    infection_time = np.floor(distance / speed + rng.exponential(2, len(centers)))
+    infection_time[first] = 0
+
+    cell_ids = np.empty((timesteps + 1, grid_size, grid_size), dtype=np.int64)
+    ve = np.empty((timesteps + 1, grid_size, grid_size))
+    field = np.zeros((grid_size, grid_size))
+    for t in range(timesteps + 1):
+        # boundary sites take the id of a random neighbour
+        shifted = np.roll(ids, rng.integers(-1, 2, 2), axis=(0, 1))
+        cell_ids[t] = np.where(rng.random(ids.shape) < 0.05, shifted, ids)
+        infected = infection_time[cell_ids[t] - 1] <= t
+        field = field + 0.25 * (
+            np.roll(field, 1, 0)
+            + np.roll(field, -1, 0)
+            + np.roll(field, 1, 1)
+            + np.roll(field, -1, 1)
+            - 4 * field
+        )
+        field = 0.95 * field + infected * rng.uniform(0.5, 1.5, field.shape)
+        ve[t] = field
+    return cell_ids, infection_time, ve
+
+
+def write_matrix_logger(path, values, fmt):
+    """Matrix logger layout of Morpheus: per timestep a header line with the grid
+    size and the column numbers, then one line per grid row."""
+    grid_size = values.shape[-1]
+    header = "\t".join([str(grid_size)] + [str(x) for x in range(grid_size)])
+    with open(path, "w") as f:
+        for grid in values:
+            f.write(header + "\n")
+            for y, row in enumerate(grid):
+                f.write("\t".join([str(y)] + [fmt % x for x in row]) + "\n")
+
+
+def write_simulation(path, grid_size, cell_nr, timesteps, seed=0):
+    """Writes logger_1, logger_2, logger_4_cell.id and logger_6_Ve of one synthetic
+    simulation into the directory path."""
+    os.makedirs(path, exist_ok=True)
+    cell_ids, infection_time, ve = simulate(grid_size, cell_nr, timesteps, seed)
+    write_matrix_logger(os.path.join(path, "logger_6_Ve.csv"), ve, "%.17g")
+    write_matrix_logger(os.path.join(path, "logger_4_cell.id.csv"), cell_ids, "%d")
+
+    times = np.arange(timesteps + 1)
+    states = (infection_time[np.newaxis, :] <= times[:, np.newaxis]).astype(int)
+    with open(os.path.join(path, "logger_1.csv"), "w") as f:
+        f.write("time\tcell.id\tV\n")
+        for t in times:
+            for cell, state in enumerate(states[t], start=1):
+                f.write("%d\t%d\t%d\n" % (t, cell, state))
+    with open(os.path.join(path, "logger_2.csv"), "w") as f:
+        f.write("time\tcelltype.target.size\tcelltype.infected.size\n")
+        for t in times:
+            infected = states[t].sum()
+            f.write("%d\t%d\t%d\n" % (t, cell_nr - 1 - infected, infected))
+
+
+def simulation_name(params, fixed_params=None):
+    """Output directory name of SimulationRunner for a parameter dict."""
+    params = dict(params, **(fixed_params or {}))
+    return "_".join("-".join((key, str(value))) for key, value in params.items())
+
+
+def write_folder(
+    folder, nr_of_simulations, grid_size, cell_nr, timesteps, prior_names, seed=0
+):
+    """Writes nr_of_simulations synthetic simulations with uniform parameters into
+    folder, named like the output of SimulationRunner. Returns their paths."""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(nr_of_simulations):
+        params = dict(zip(prior_names, rng.random(len(prior_names))))
+        path = os.path.join(folder, simulation_name(params, {"cV": 0.5, "pV": 0.5}))
+        write_simulation(path, grid_size, cell_nr, timesteps, seed + i)
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="SyntheticMorpheus",
+        description="Writes synthetic Morpheus output folders for tests and benchmarks",
+    )
+    parser.add_argument("folder", type=str)
+    parser.add_argument("-n", "--simulations", type=int, default=10)
+    parser.add_argument("-g", "--grid_size", type=int, default=10)
+    parser.add_argument("-c", "--cell_nr", type=int, default=51)
+    parser.add_argument("-t", "--timesteps", type=int, default=50)
+    parser.add_argument("-p", "--prior_names", nargs="+", default=["DV", "bcf"])
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    write_folder(
+        args.folder,
+        args.simulations,
+        args.grid_size,
+        args.cell_nr,
+        args.timesteps,
+        args.prior_names,
+        args.seed,
+    )
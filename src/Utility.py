@@ -1,10 +1,22 @@
+import contextlib
 import functools
+import mmap
+import os
+import threading
 import time
+import numpy as np
+from Metrics import metrics
 
 
 def timeit(func):
+    """Times func as timer function.<name> of the metrics registry, or prints its
+    runtime if the registry is disabled."""
+
     @functools.wraps(func)
     def new_func(*args, **kwargs):
+        if metrics.enabled:
+            with metrics.time("function." + func.__name__):
+                return func(*args, **kwargs)
         start_time = time.time()
         result = func(*args, **kwargs)
         elapsed_time = time.time() - start_time
@@ -16,3 +28,75 @@ def timeit(func):
         return result
 
     return new_func
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """Temporary path next to path, unique per process and thread, which replaces
+    path once the block finished. Readers never see a partially written file and
+    concurrent writers of the same file do not interfere."""
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="wb", **kwargs):
+    """File object for writing path atomically, see atomic_path."""
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+
+
+def shared_empty(shape, dtype):
+    """Uninitialized array backed by an anonymous shared mapping, so that writes of
+    forked worker processes are visible to the parent."""
+    count = int(np.prod(shape))
+    buffer = mmap.mmap(-1, max(count * np.dtype(dtype).itemsize, 1))
+    return np.frombuffer(buffer, dtype=dtype, count=count).reshape(shape)
+
+
+def logger_stat(pathname, loggers):
+    """Summed size and latest modification time of the loggers of a simulation
+    directory, missing loggers are skipped."""
+    size, mtime_ns = 0, 0
+    for logger in loggers:
+        try:
+            stat = os.stat(os.path.join(pathname, logger))
+        except FileNotFoundError:
+            continue
+        size += stat.st_size
+        mtime_ns = max(mtime_ns, stat.st_mtime_ns)
+    return size, mtime_ns
+
+
+def available_memory():
+    """Bytes available to new allocations without swapping, within the cgroup limit
+    of a container, None if unknown."""
+    available = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        try:
+            available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            pass
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        with open("/sys/fs/cgroup/memory.current") as f:
+            usage = int(f.read())
+        if limit != "max":
+            cgroup_available = int(limit) - usage
+            if available is None or cgroup_available < available:
+                available = cgroup_available
+    except (OSError, ValueError):
+        pass
+    return available
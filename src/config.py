@@ -29,6 +29,29 @@ timesteps = 50
 cut_off_start = 9
 cut_off_end = 10
 spatial = True
+viral_load_dtype = "float32"  # "float16" is lossy, 5 instead of 7 bytes per site
+simulation_workers = 1  # concurrent Morpheus processes per batch, None uses all cores
+simulation_timeout = 600  # seconds until a Morpheus run is killed, None waits forever
+completion_timeout = 10  # seconds to wait for the loggers after Morpheus exited
+morpheus_executable = "morpheus"  # src/FakeMorpheus.py runs without Morpheus
+rewrite_model = False  # run a copy of the model without plots and unused loggers
+scratch_dir = None  # run Morpheus here and keep compressed archives, "auto" uses tmpfs
+simulation_store = False  # reuse parsed simulations of already simulated parameters
+simulation_store_dir = None  # None keeps the store inside the output folder
+read_workers = 1  # processes parsing offline simulations, None uses all cores
+memory_budget = None  # GB of offline data kept in RAM, None uses the available memory
+memmap_dir = None  # memory map of offline data over the budget, None uses the workdir
+memory_report = False  # RSS and tracemalloc per read phase into the workdir
+parse_cache = False  # cache parsed loggers between runs
+parse_cache_dir = None  # None keeps the cache next to the raw simulation output
+offline_manifest = False  # index the output folder in a manifest updated incrementally
+offline_param_ranges = None  # e.g. {"DV": (0.0, 0.5)}, filters the manifest
+offline_manifest_refresh = False  # re-check every directory, not only a changed folder
+offline_store = None  # directory of a memory-mapped dataset, None reads into RAM
+offline_refresh = False  # append new simulations to the offline store
+offline_records = None  # directory of sharded TFRecord files streamed by tf.data
+records_per_shard = 1024
+shuffle_buffer = 4096  # simulations held in the tf.data shuffle buffer
 
 # training hyperparameter
 param_nr = len(prior_func())
@@ -42,6 +65,10 @@ model_name = "morpheus"
 training_mode = "offline"
 amortizer_name = "emune_amortizer"
 optional_stopping = True
+graph_configurator = False  # configure batches with float32 TensorFlow ops
+prefetch_batches = 0  # batches simulated ahead during online training, 0 disables
+prefetch_workers = 1  # background threads filling the prefetch queue
+metrics = False  # write stage timings to metrics.json and metrics.csv in the workdir
 
 # which plots and diagnostics
 losses = True
@@ -55,6 +82,7 @@ slope = True
 post_eval = True
 resimulation = True
 nr_resimulations = 3
+resimulation_workers = None  # concurrent resimulations, None uses all cores
 run_resimualtions = (
     sbc_ecdf
     or posterior_scores
@@ -65,3 +93,5 @@ run_resimualtions = (
     or resimulation
 )
 resimulation_param = {"simulations": 100, "post_samples": 500}
+validation_source = "simulate"  # "offline" holds the validation set out of offline data
+validation_seed = 0  # selects the held-out offline simulations